@@ -22,12 +22,14 @@ from pyethapp import __version__
 import utils
 
 from rno_service import RNOService
+import rno_bench
 
 slogging.configure(config_string=':debug')
 log = slogging.get_logger('app')
 
 
-services = [DBService, NodeDiscovery, PeerManager, ChainService, JSONRPCServer, Console, RNOService]
+# RNOService has to be registered before JSONRPCServer, which registers its rno_ methods
+services = [DBService, NodeDiscovery, PeerManager, ChainService, RNOService, JSONRPCServer, Console]
 services += utils.load_contrib_services()
 
 
@@ -189,6 +191,36 @@ def blocktest(ctx, file):
     app.stop()
 
 
+@app.command()
+@click.option('num_requests', '--requests', '-n', default=1000, help='Number of requests')
+@click.option('num_keys', '--keys', '-k', default=100, help='Number of requesting keys')
+@click.option('output', '--output', '-o', type=click.File('wb'), default='-',
+              help='File the json results are written to')
+@click.pass_context
+def rnobench(ctx, num_requests, num_keys, output):
+    """Benchmark the RNO with synthetic requests.
+
+    Requests are fed to the RNO service on a chain in an ephemeral db, the
+    throughput, latency percentiles and cpu time per request are written as
+    json. Use -c to set the rno config, e.g. `-c rno.crypto_workers=4`.
+    """
+    app = EthApp(ctx.obj['config'])
+    app.config['db']['implementation'] = 'EphemDB'
+
+    # register services
+    for service in services:
+        assert issubclass(service, BaseService)
+        if service.name in (DBService.name, ChainService.name, RNOService.name):
+            assert service.name not in app.services
+            if service.name == ChainService.name:
+                rno_bench.init_chain(app, num_requests)  # with a genesis funding the RNO
+            service.register_with_app(app)
+            assert hasattr(app.services, service.name)
+
+    results = rno_bench.run(app, num_requests, num_keys)
+    output.write(json.dumps(results, sort_keys=True) + '\n')
+
+
 if __name__ == '__main__':
     #  python app.py 2>&1 | less +F
     app()
@@ -5,22 +5,52 @@ import rlp
 from rlp.utils import encode_hex
 from ethereum import processblock
 from synchronizer import Synchronizer
+from pow_verifier import PoWVerifier
+from tx_pool import TransactionPool
 from ethereum.slogging import get_logger
 from ethereum.chain import Chain
 from devp2p.service import WiredService
 import eth_protocol
 import gevent
 from gevent.queue import Queue
+from collections import OrderedDict
+from utils import LRUCache
 log = get_logger('eth.chainservice')
 
 
+class TimeSliceScheduler(object):
+
+    """
+    Lets a greenlet doing long running work yield to the others, but only once
+    it has run for `time_slice` seconds, so the work is not slowed down by a
+    context switch per step.
+    """
+
+    def __init__(self, time_slice=0.01):
+        self.time_slice = time_slice
+        self.greenlet = None  # the greenlet the current slice belongs to
+        self.slice_started = time.time()
+
+    def checkpoint(self):
+        "yields if the calling greenlet has used up its time slice"
+        current = gevent.getcurrent()
+        if current is not self.greenlet:
+            self.greenlet = current
+            self.slice_started = time.time()
+        elif time.time() - self.slice_started >= self.time_slice:
+            # a timer, unlike sleep(0), makes sure the hub polls for io (p2p, rpc)
+            gevent.sleep(0.001)
+            self.slice_started = time.time()
+
+scheduler = TimeSliceScheduler()
+
+
 # patch to get context switches between tx replay
 processblock_apply_transaction = processblock.apply_transaction
 
 
 def apply_transaction(block, tx):
-    log.debug('apply_transaction ctx switch', at=time.time())
-    gevent.sleep(0.001)
+    scheduler.checkpoint()
     return processblock_apply_transaction(block, tx)
 processblock.apply_transaction = apply_transaction
 
@@ -30,19 +60,80 @@ rlp_hash_hex = lambda data: encode_hex(sha3(rlp.encode(data)))
 
 class DuplicatesFilter(object):
 
+    """Remembers the `max_items` most recently seen items, checks are O(1)."""
+
     def __init__(self, max_items=128):
         self.max_items = max_items
-        self.filter = list()
+        self.filter = LRUCache(max_items)
 
     def known(self, data):
-        if data not in self.filter:
-            self.filter.append(data)
-            if len(self.filter) > self.max_items:
-                self.filter.pop(0)
-            return False
-        else:
-            self.filter.append(self.filter.pop(0))
+        "returns whether `data` has been seen before and remembers it as the most recent item"
+        if self.filter.get(data):
             return True
+        self.filter[data] = True
+        return False
+
+    def forget(self, data):
+        "removes `data`, so it is not known anymore"
+        self.filter.pop(data)
+
+    def __contains__(self, data):
+        return data in self.filter
+
+    def __len__(self):
+        return len(self.filter)
+
+
+class StageCounter(object):
+
+    """Counts the items processed by a stage of a pipeline and the time it was busy."""
+
+    def __init__(self):
+        self.count = 0
+        self.busy = 0.
+
+    def add(self, num, started_at):
+        self.count += num
+        self.busy += time.time() - started_at
+
+    @property
+    def throughput(self):
+        "items per second while busy"
+        return self.count / self.busy if self.busy else 0.
+
+    def __str__(self):
+        return '%d in %.2fs, %.1f/s' % (self.count, self.busy, self.throughput)
+
+
+class TransactionBroadcaster(object):
+
+    """
+    Coalesces transactions into `transactions` messages of up to `max_txs`
+    transactions. A message is sent at the latest `window` seconds after its
+    first transaction was added.
+    """
+
+    def __init__(self, broadcast_cb, max_txs=256, window=0.1):
+        self.broadcast_cb = broadcast_cb
+        self.max_txs = max_txs
+        self.window = window
+        self.txs = []
+        self.deadline = None
+
+    def add(self, tx):
+        self.txs.append(tx)
+        if len(self.txs) >= self.max_txs:
+            self.flush()
+        elif self.deadline is None:
+            self.deadline = gevent.spawn_later(self.window, self.flush)
+
+    def flush(self):
+        if self.deadline is not None and self.deadline is not gevent.getcurrent():
+            self.deadline.kill()
+        self.deadline = None
+        txs, self.txs = self.txs, []
+        if txs:
+            self.broadcast_cb(txs)
 
 
 class ChainService(WiredService):
@@ -52,7 +143,9 @@ class ChainService(WiredService):
     """
     # required by BaseService
     name = 'chain'
-    default_config = dict(eth=dict(privkey_hex=''))
+    # pow_workers: number of processes checking the proof of work of new blocks, 0 checks inline
+    # time_slice: seconds the tx replay may run before it yields to p2p and rpc
+    default_config = dict(eth=dict(privkey_hex='', pow_workers=0, time_slice=0.01))
 
     # required by WiredService
     wire_protocol = eth_protocol.ETHProtocol  # create for each peer
@@ -63,7 +156,15 @@ class ChainService(WiredService):
     synchronizer = None
     config = None
     block_queue_size = 1024
+    pow_batch_size = 256  # max number of queued blocks whose proof of work is checked at once
+    verified_queue_size = 256  # max number of verified blocks waiting to be imported
     transaction_queue_size = 1024
+    tx_pool_size = 4096  # max number of transactions received from peers which are pooled
+    tx_broadcast_max = 256  # max transactions per broadcasted message
+    tx_broadcast_window = 0.1  # max seconds a transaction waits to be broadcasted
+    broadcast_filter_size = 32768  # number of broadcasted blocks remembered
+    known_blocks_size = 1024  # per peer, number of blocks remembered the peer has
+    known_txs_size = 8192  # per peer, number of transactions remembered the peer has
 
     def __init__(self, app):
         self.config = app.config
@@ -71,17 +172,42 @@ class ChainService(WiredService):
         assert self.db is not None
         super(ChainService, self).__init__(app)
         log.info('initializing chain')
+        self.on_new_head_cbs = []
         self.chain = Chain(self.db, new_head_cb=self._on_new_head)
         self.synchronizer = Synchronizer(self, force_sync=None)
         self.chain.coinbase = privtoaddr(self.config['eth']['privkey_hex'].decode('hex'))
 
         self.block_queue = Queue(maxsize=self.block_queue_size)
+        self.verified_queue = Queue(maxsize=self.verified_queue_size)
+        self.verifying = []  # blocks taken off the block_queue, not yet in the verified_queue
+        self.import_stages = {'verify': StageCounter(), 'import': StageCounter()}
         self.transaction_queue = Queue(maxsize=self.transaction_queue_size)
         self.add_blocks_lock = False
-        self.broadcast_filter = DuplicatesFilter()
+        self.pow_verifier = PoWVerifier(self.config['eth']['pow_workers'])
+        scheduler.time_slice = self.config['eth']['time_slice']
+        self.broadcast_filter = DuplicatesFilter(self.broadcast_filter_size)
+        # per peer, the blocks and transactions the peer sent us or was sent
+        self.known_blocks = dict()  # proto: DuplicatesFilter
+        self.known_txs = dict()  # proto: DuplicatesFilter
+        # transactions created by this node, which are not yet in the chain
+        self.local_pending = OrderedDict()
+        # transactions received from peers, which are not yet in the chain
+        self.tx_pool = TransactionPool(self.chain, self.tx_pool_size)
+        self.tx_broadcaster = TransactionBroadcaster(self._broadcast_transactions,
+                                                     self.tx_broadcast_max,
+                                                     self.tx_broadcast_window)
+
+    def stop(self):
+        self.pow_verifier.stop()
+        super(ChainService, self).stop()
 
     def _on_new_head(self, block):
-        pass
+        if self.local_pending:
+            for tx in block.get_transactions():
+                self.local_pending.pop(tx.hash, None)
+        self.tx_pool.on_new_head(block)
+        for cb in self.on_new_head_cbs:
+            cb(block)
 
     def add_block(self, t_block, proto):
         "adds a block to the block_queue and spawns _add_block if not running"
@@ -90,53 +216,159 @@ class ChainService(WiredService):
             self.add_blocks_lock = True
             gevent.spawn(self._add_blocks)
 
+    # Blocks are imported by a pipeline of two stages connected by bounded
+    # queues: block_queue -> verify -> verified_queue -> import. The proof of
+    # work of the next batch is checked while the current one is imported.
+
     def _add_blocks(self):
         log.debug('add_blocks', qsize=self.block_queue.qsize())
+        verifier = None
         try:
-            while not self.block_queue.empty():
-                t_block, proto = self.block_queue.get()
-                if t_block.header.hash in self.chain:
-                    log.warn('known block', block=t_block)
-                    continue
-                if t_block.header.prevhash not in self.chain:
-                    log.warn('missing parent', block=t_block)
-                    continue
-                if not t_block.header.check_pow():
-                    log.warn('invalid pow', block=t_block)
-                    # FIXME ban node
-                    continue
-                try:  # deserialize
+            while True:
+                verifier = gevent.spawn(self._verify_blocks)
+                for t_block, proto, pow_valid in iter(self.verified_queue.get, None):
                     st = time.time()
-                    block = t_block.to_block(db=self.chain.db)
-                    elapsed = time.time() - st
-                    log.debug('deserialized', elapsed='%.2fs' % elapsed,
-                              gas_used=block.gas_used, gpsec=int(block.gas_used / elapsed))
-                except processblock.InvalidTransaction as e:
-                    log.warn('invalid transaction', block=t_block, error=e)
-                    # FIXME ban node
-                    continue
-
-                if self.chain.add_block(block):
-                    log.debug('added', block=block)
-                gevent.sleep(0.001)
+                    self._add_verified_block(t_block, proto, pow_valid)
+                    self.import_stages['import'].add(1, st)
+                verifier = None  # it ended with the None
+                # blocks may have been queued after the verify stage finished
+                if self.block_queue.empty():
+                    break
+            log.debug('import pipeline drained', **dict((name, str(counter)) for name, counter
+                                                       in self.import_stages.items()))
         finally:
+            if verifier is not None:  # the import stage failed
+                self._stop_verify_blocks(verifier)
             self.add_blocks_lock = False
 
+    def _stop_verify_blocks(self, verifier):
+        """kills the verify stage and puts the blocks not imported back in front of the
+        block_queue, so the next import starts clean and with them
+        """
+        verifier.kill(block=False)
+        verified = []
+        while True:
+            while not self.verified_queue.empty():  # may unblock its put
+                verified.append(self.verified_queue.get())
+            if verifier.ready():  # its None was drained above
+                break
+            gevent.sleep(0)
+        unimported = [item[:2] for item in verified if item is not None] + self.verifying
+        self.verifying = []
+        queued = unimported + [self.block_queue.get() for _ in range(self.block_queue.qsize())]
+        for item in queued[:self.block_queue_size]:
+            self.block_queue.put_nowait(item)
+        log.warn('block import failed', requeued=len(unimported),
+                 dropped=max(0, len(queued) - self.block_queue_size))
+
+    def _verify_blocks(self):
+        "first stage: checks the proof of work of the queued blocks, a batch at a time"
+        try:
+            while not self.block_queue.empty():
+                queued = []
+                while not self.block_queue.empty() and len(queued) < self.pow_batch_size:
+                    t_block, proto = self.block_queue.get()
+                    if t_block.header.hash in self.chain:
+                        log.warn('known block', block=t_block)
+                        continue
+                    queued.append((t_block, proto))
+                self.verifying = queued
+                st = time.time()
+                valid_pow = self.pow_verifier.verify([t_block.header for t_block, _ in queued])
+                self.import_stages['verify'].add(len(queued), st)
+                for (t_block, proto), pow_valid in zip(queued, valid_pow):
+                    self.verified_queue.put((t_block, proto, pow_valid))  # blocks if full
+                    queued.pop(0)
+        finally:
+            self.verified_queue.put(None)  # ends the import stage
+
+    def _add_verified_block(self, t_block, proto, pow_valid):
+        "second stage: adds a block of which the proof of work was checked already"
+        if t_block.header.hash in self.chain:
+            log.warn('known block', block=t_block)
+            return
+        if t_block.header.prevhash not in self.chain:
+            log.warn('missing parent', block=t_block)
+            return
+        if not pow_valid:
+            log.warn('invalid pow', block=t_block)
+            # FIXME ban node
+            return
+        try:  # deserialize
+            st = time.time()
+            block = t_block.to_block(db=self.chain.db)
+            elapsed = time.time() - st
+            log.debug('deserialized', elapsed='%.2fs' % elapsed,
+                      gas_used=block.gas_used, gpsec=int(block.gas_used / elapsed))
+        except processblock.InvalidTransaction as e:
+            log.warn('invalid transaction', block=t_block, error=e)
+            # FIXME ban node
+            return
+
+        if self.chain.add_block(block):
+            log.debug('added', block=block)
+        scheduler.checkpoint()
+
     def broadcast_newblock(self, block, chain_difficulty, origin=None):
         assert isinstance(block, eth_protocol.TransientBlock)
-        if self.broadcast_filter.known(block.header.hash):
+        blockhash = block.header.hash
+        if self.broadcast_filter.known(blockhash):
             log.debug('already broadcasted block')
         else:
-            log.debug('broadcasting newblock', origin=origin)
+            # skip the peers which already have the block
+            exclude = [origin] + [p for p, known in self.known_blocks.items()
+                                  if p is not origin and blockhash in known]
+            log.debug('broadcasting newblock', origin=origin, skipped=len(exclude) - 1)
             bcast = self.app.services.peermanager.broadcast
             bcast(eth_protocol.ETHProtocol, 'newblock', args=(block, chain_difficulty),
-                  num_peers=None, exclude_protos=[origin])
+                  num_peers=None, exclude_protos=exclude)
+            for known in self.known_blocks.values():
+                known.known(blockhash)
+
+    def add_local_transaction(self, tx):
+        """Adds a transaction created by this node to the pending pool and the
+        head_candidate, and queues it for broadcasting.
+
+        :returns: `False` if the transaction is invalid, `True` otherwise
+        """
+        if tx.hash in self.local_pending:
+            return True
+        if self.chain.add_transaction(tx) is False:
+            return False
+        self.local_pending[tx.hash] = tx
+        self.tx_broadcaster.add(tx)
+        return True
+
+    def resend_transaction(self, tx):
+        """Broadcasts a pending transaction created by this node again, also to
+        the peers it was sent to before, e.g. because it was not mined.
+        """
+        for known in self.known_txs.values():
+            known.forget(tx.hash)
+        self.tx_broadcaster.add(tx)
+
+    def _broadcast_transactions(self, txs):
+        log.debug('broadcasting transactions', count=len(txs))
+        for proto, known in self.known_txs.items():
+            # a transaction must not be sent twice to a peer
+            new_txs = [tx for tx in txs if not known.known(tx.hash)]
+            if new_txs:
+                proto.send_transactions(*new_txs)
+
+    def _mark_known(self, filters, proto, hashes):
+        "remembers that the peer of `proto` has `hashes`, `filters` is known_blocks or known_txs"
+        known = filters.get(proto)
+        if known is not None:
+            for h in hashes:
+                known.known(h)
 
     # wire protocol receivers ###########
 
     def on_wire_protocol_start(self, proto):
         log.debug('on_wire_protocol_start', proto=proto)
         assert isinstance(proto, self.wire_protocol)
+        self.known_blocks[proto] = DuplicatesFilter(self.known_blocks_size)
+        self.known_txs[proto] = DuplicatesFilter(self.known_txs_size)
         # register callbacks
         proto.receive_status_callbacks.append(self.on_receive_status)
         proto.receive_transactions_callbacks.append(self.on_receive_transactions)
@@ -154,6 +386,8 @@ class ChainService(WiredService):
     def on_wire_protocol_stop(self, proto):
         assert isinstance(proto, self.wire_protocol)
         log.debug('on_wire_protocol_stop', proto=proto)
+        self.known_blocks.pop(proto, None)
+        self.known_txs.pop(proto, None)
 
     def on_receive_status(self, proto, eth_version, network_id, chain_difficulty, chain_head_hash,
                           genesis_hash):
@@ -176,6 +410,7 @@ class ChainService(WiredService):
         transactions = self.chain.get_transactions()
         if transactions:
             log.debug("sending transactions", remote_id=proto)
+            self._mark_known(self.known_txs, proto, [tx.hash for tx in transactions])
             proto.send_transactions(*transactions)
 
     # transactions
@@ -183,11 +418,15 @@ class ChainService(WiredService):
     def on_receive_transactions(self, proto, transactions):
         "receives rlp.decoded serialized"
         log.debug('remote_transactions_received', count=len(transactions), remote_id=proto)
-        log.debug('skipping, FIXME')
-        return
-        for tx in transactions:
-            # fixme bloomfilter
-            self.chain.add_transaction(tx)
+        self._mark_known(self.known_txs, proto, [tx.hash for tx in transactions])
+        added = self.tx_pool.add_transactions(transactions)
+        log.debug('pooled transactions', count=len(added), pool_size=len(self.tx_pool),
+                  evicted=self.tx_pool.evicted)
+        # requests to the RNO are handled as soon as they are received
+        rno = getattr(self.app.services, 'rno', None)
+        if rno is not None:
+            for tx in added:
+                rno.add_transaction(tx)
 
     # blockhashes ###########
 
@@ -237,8 +476,10 @@ class ChainService(WiredService):
         log.debug("recv blocks", count=len(transient_blocks), remote_id=proto,
                   highest_number=max(x.header.number for x in transient_blocks))
         if transient_blocks:
+            self._mark_known(self.known_blocks, proto, [b.header.hash for b in transient_blocks])
             self.synchronizer.receive_blocks(proto, transient_blocks)
 
     def on_receive_newblock(self, proto, block, chain_difficulty):
         log.debug("recv newblock", block=block, remote_id=proto)
+        self._mark_known(self.known_blocks, proto, [block.header.hash])
         self.synchronizer.receive_newblock(proto, block, chain_difficulty)
@@ -108,7 +108,7 @@ class JSONRPCServer(BaseService):
 
         self.dispatcher = LoggingDispatcher()
         # register sub dispatchers
-        for subdispatcher in (Web3, Net, Compilers, DB, Chain, Miner, FilterManager):
+        for subdispatcher in (Web3, Net, Compilers, DB, Chain, Miner, FilterManager, RNO):
             subdispatcher.register(self)
 
         transport = WsgiServerTransport(queue_class=gevent.queue.Queue)
@@ -968,3 +968,44 @@ class FilterManager(Subdispatcher):
             return [None] * len(filter_.logs)
         else:
             return self.filters[id_].logs
+
+
+class RNO(Subdispatcher):
+
+    """Subdispatcher for the random number oracle."""
+
+    prefix = 'rno_'
+    required_services = ['rno']
+
+    @public
+    def stats(self):
+        """Performance statistics of the RNO pipeline, all times in milliseconds."""
+        d = self.rno.stats.report()
+        queue = self.rno.tx_queue
+        d['queue'] = dict(scheduling=queue.scheduling, depth=queue.qsize(),
+                          dropped=dict(queue.dropped),
+                          oldest_wait=queue.oldest_wait() * 1000)
+        reservoir = self.rno.reservoir
+        d['reservoir'] = dict(size=len(reservoir), hits=reservoir.hits, misses=reservoir.misses)
+        d['pubkey_cache'] = dict(hits=self.rno.pubkeys.hits, misses=self.rno.pubkeys.misses)
+        d['unconfirmed'] = dict(count=len(self.rno.tracker), resent=self.rno.tracker.resent)
+        return d
+
+    @public
+    @decode_arg('rlp_tx', data_decoder)
+    @encode_res(data_encoder)
+    def request(self, rlp_tx):
+        """Answers a request off chain and returns the encrypted numbers at once.
+
+        The request is a signed transaction to the RNO, as it would be sent on
+        chain, but it is neither broadcasted nor mined. The numbers are anchored
+        on chain later, batched with others.
+        """
+        try:
+            tx = rlp.decode(rlp_tx, Transaction)
+        except (rlp.DecodingError, rlp.DeserializationError):
+            raise BadRequestError('Invalid transaction')
+        try:
+            return self.rno.request(tx)
+        except ValueError as e:
+            raise BadRequestError(str(e))
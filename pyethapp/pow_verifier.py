@@ -0,0 +1,54 @@
+"""
+Proof of work verification off the gevent hub.
+
+Checking the ethash proof of work of a block header is CPU bound and dominates
+the import of blocks during a sync. :class:`PoWVerifier` checks many headers at
+once in worker processes and returns the results in the order of the headers.
+Each worker keeps its own ethash caches, so they are built once per worker and
+epoch.
+"""
+import multiprocessing
+import gevent
+import rlp
+from ethereum.blocks import BlockHeader
+from ethereum.slogging import get_logger
+
+log = get_logger('eth.pow')
+
+
+def check_pow(rlp_header):
+    "Job: check the proof of work of the rlp encoded block header"
+    return rlp.decode(rlp_header, BlockHeader).check_pow()
+
+
+class PoWVerifier(object):
+
+    """
+    Checks the proof of work of block headers.
+
+    With `num_workers` > 0 the headers are checked by that many worker
+    processes, otherwise they are checked inline.
+    """
+
+    def __init__(self, num_workers=0):
+        if num_workers > 0:
+            log.info('starting pow workers', num=num_workers)
+            self.pool = multiprocessing.Pool(num_workers)
+        else:
+            self.pool = None
+
+    def verify(self, headers):
+        "returns whether the proof of work of each of `headers` is valid, in the order of `headers`"
+        if not headers:
+            return []
+        if self.pool is None:
+            return [header.check_pow() for header in headers]
+        jobs = [rlp.encode(header) for header in headers]
+        # wait for the workers in a thread so only the calling greenlet blocks
+        return gevent.get_hub().threadpool.apply(self.pool.map, (check_pow, jobs))
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
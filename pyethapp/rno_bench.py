@@ -0,0 +1,114 @@
+"""
+Synthetic load for the RNO pipeline, used by the `rnobench` command.
+
+Request transactions are signed upfront by `num_keys` synthetic requesters and
+then fed into :meth:`RNOService.add_transaction` as fast as the request queue
+accepts them. The chain runs on an ephemeral db, its genesis block funds the RNO
+identities. No blocks are mined, so the gas limit of the genesis is raised until
+all deliveries of the run fit into the head candidate.
+"""
+import time
+import resource
+import gevent
+from ethereum.blocks import genesis, GENESIS_GAS_LIMIT
+from ethereum.chain import Chain
+from ethereum.transactions import Transaction
+from ethereum.utils import sha3, privtoaddr
+from ethereum.slogging import get_logger
+from rno_stats import RNOStats, monotonic
+
+log = get_logger('rno.bench')
+
+# upper bound of the gas a delivery uses per request, the intrinsic gas of a
+# single delivery is about 36000
+delivery_gas = 50000
+
+
+def mk_requests(to, num_requests, num_keys):
+    "returns `num_requests` signed requests to `to`, sent round robin by `num_keys` keys"
+    keys = [sha3('rnobench:%d' % i) for i in range(num_keys)]
+    txs = []
+    for i in range(num_requests):
+        nonce, key = divmod(i, num_keys)
+        txs.append(Transaction(nonce, 10**12, 25000, to, 0, '').sign(keys[key]))
+    return txs
+
+
+def init_chain(app, num_requests, balance=10**30):
+    """Initializes the chain in the db of `app` with a genesis block allocating
+    `balance` to each RNO identity, enough to pay for all deliveries, and a gas
+    limit leaving room for the deliveries of `num_requests`. Must be called
+    before the chain service is registered.
+    """
+    config = app.config
+    privkeys = [config['eth']['privkey_hex']] + config['rno']['privkeys_hex']
+    alloc = dict((privtoaddr(k.decode('hex')), dict(balance=balance)) for k in privkeys)
+    gas_limit = max(GENESIS_GAS_LIMIT, 2 * num_requests * delivery_gas)
+    db = app.services.db
+    Chain(db, genesis=genesis(db, alloc, gas_limit=gas_limit))
+
+
+def undelivered(rno):
+    "the number of requests whose delivery was rejected, they wait for a new head"
+    return sum(len(batch) for batch in rno.undelivered)
+
+
+def finished(rno):
+    """the number of requests which are delivered, invalid, inadmissible or dropped,
+    or wait for a new head to be delivered again
+    """
+    errors = rno.stats.errors
+    return (rno.stats.delivered + errors.get('invalid', 0) + errors.get('inadmissible', 0) +
+            sum(rno.tx_queue.dropped.values()) + undelivered(rno))
+
+
+def cpu_time():
+    "cpu seconds used by this process and its terminated children"
+    return sum(r.ru_utime + r.ru_stime for r in (resource.getrusage(resource.RUSAGE_SELF),
+                                                 resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def run(app, num_requests, num_keys, timeout=600.):
+    """Runs the benchmark on the registered but not yet started `app`.
+
+    :returns: the results as json encodable dict, times in milliseconds
+    """
+    rno = app.services.rno
+    rno.stats = RNOStats(window=timeout, max_samples=num_requests)
+
+    log.info('signing requests', num=num_requests, keys=num_keys)
+    txs = mk_requests(rno.my_addr, num_requests, num_keys)
+
+    app.start()
+    cpu_started = cpu_time()
+    started_at = monotonic()
+    for tx in txs:
+        while rno.tx_queue.full():
+            gevent.sleep(0.001)
+        rno.add_transaction(tx)
+    while finished(rno) < num_requests:
+        if monotonic() - started_at > timeout:
+            log.warn('benchmark timed out')
+            break
+        gevent.sleep(0.01)
+    elapsed = monotonic() - started_at
+    report = rno.stats.report()
+    app.stop()  # terminates the crypto workers, so their cpu time is accounted
+    cpu = cpu_time() - cpu_started
+
+    return dict(timestamp=int(time.time()),
+                client_version=app.config['client_version'],
+                config=dict((k, v) for k, v in app.config['rno'].items() if k != 'privkeys_hex'),
+                requests=num_requests,
+                keys=num_keys,
+                delivered=report['delivered'],
+                undelivered=undelivered(rno),
+                errors=report['errors'],
+                dropped=sum(rno.tx_queue.dropped.values()),
+                elapsed=elapsed * 1000,
+                requests_per_second=report['delivered'] / elapsed,
+                latency_p50=report.get('latency_p50'),
+                latency_p95=report.get('latency_p95'),
+                latency_p99=report.get('latency_p99'),
+                cpu_per_request=cpu * 1000 / max(1, report['delivered']),
+                stages=report['stages'])
@@ -0,0 +1,285 @@
+"""
+Crypto stage of the RNO pipeline.
+
+Recovering the requester's pubkey, ECIES encrypting the random number and
+signing the delivery transaction are CPU bound. Done in the RNO greenlet they
+block the gevent hub and with it p2p and JSON-RPC. :class:`CryptoPool` runs
+them in worker processes and returns the results in the order of the jobs.
+
+The job functions are module level so they can be pickled. They take and
+return rlp encoded transactions, as these are cheap to send between processes.
+
+:class:`EntropyReservoir` keeps random numbers and ECIES ephemeral keys ready,
+so neither has to be generated while a request is waiting. :class:`PubkeyCache`
+saves the recovery for requesters whose pubkey is already known.
+"""
+import os
+import multiprocessing
+from collections import deque
+from hashlib import sha256
+
+import gevent
+from gevent.event import Event
+import pyelliptic
+import rlp
+from devp2p.crypto import ECCx, CURVE, recover, _encode_sig, eciesKDF, hmac_sha256
+from ethereum.transactions import Transaction, UnsignedTransaction
+from ethereum.utils import sha3, privtoaddr
+from ethereum.slogging import get_logger
+from utils import LRUCache
+
+log = get_logger('rno.crypto')
+
+
+# per process state, set up by _init_worker
+_privkeys = dict()  # addr: privkey
+
+
+def _init_worker(privkeys):
+    for privkey in privkeys:
+        _privkeys[privtoaddr(privkey)] = privkey
+
+
+def signing_hash(tx):
+    "the hash the sender of `tx` signed"
+    return sha3(rlp.encode(tx, UnsignedTransaction))
+
+
+def sender_pubkey(tx):
+    "recovers the pubkey of the sender from the Electrum-style signature of `tx`"
+    return recover(signing_hash(tx), _encode_sig(tx.v, tx.r, tx.s))
+
+
+def pubtoaddr(pubkey):
+    return sha3(pubkey)[12:]
+
+
+def make_entropy(_=None):
+    """Job: generate what is needed to answer one request.
+
+    :returns: ``(number, iv, ephem_privkey, ephem_pubkey)``
+    """
+    ephem = ECCx(None)
+    rand = os.urandom(64 + 16)
+    return rand[:64], rand[64:], ephem.raw_privkey, ephem.raw_pubkey
+
+
+def ecies_encrypt(data, raw_pubkey, iv, ephem_privkey, ephem_pubkey):
+    """Same as :meth:`devp2p.crypto.ECCx.ecies_encrypt`, but uses the given
+    iv and ephemeral key instead of generating them.
+    """
+    ephem = pyelliptic.ECC(pubkey_x=ephem_pubkey[:32], pubkey_y=ephem_pubkey[32:],
+                           raw_privkey=ephem_privkey, curve=CURVE)
+    key_material = ephem.raw_get_ecdh_key(pubkey_x=raw_pubkey[:32], pubkey_y=raw_pubkey[32:])
+    key = eciesKDF(key_material, 32)
+    key_enc, key_mac = key[:16], sha256(key[16:]).digest()
+    ctx = pyelliptic.Cipher(key_enc, iv, 1, ECCx.ecies_ciphername)
+    msg = chr(0x04) + ephem_pubkey + iv + ctx.ciphering(data)
+    return msg + hmac_sha256(key_mac, msg[1 + 64:])
+
+
+def encrypt_random_number(pubkey, entropy=None, count=1):
+    """Encrypts `count` random numbers to `pubkey`.
+
+    The numbers are concatenated and encrypted as one message, so the key
+    agreement is done once for all of them.
+
+    :param entropy: an unused entry from :func:`make_entropy` or `None` to
+                    generate one
+    """
+    return encrypt_random_numbers(pubkey, entropy, count)[1]
+
+
+def encrypt_random_numbers(pubkey, entropy=None, count=1):
+    """Same as :func:`encrypt_random_number`, but returns ``(numbers, encrypted
+    numbers)``.
+    """
+    # 3) generate the random number
+    number, iv, ephem_privkey, ephem_pubkey = entropy or make_entropy()
+    if count > 1:
+        number += os.urandom(64 * (count - 1))
+
+    # 4) encrypt RN using sender's pubkey (eRN1)
+    return number, ecies_encrypt(number, pubkey, iv, ephem_privkey, ephem_pubkey)
+
+
+def recover_sender(rlp_tx):
+    """Job: recover the pubkey of the sender of `rlp_tx`.
+
+    :returns: the pubkey or `None` if the signature is invalid
+    """
+    try:
+        return sender_pubkey(rlp.decode(rlp_tx, Transaction))
+    except Exception as e:
+        log.warn('could not recover sender', error=e)
+        return None
+
+
+def encrypt_number(args):
+    """Job: encrypt the random numbers of a request.
+
+    :param args: ``(pubkey, entropy, count)``, see :func:`encrypt_random_number`
+    :returns: ``(numbers, encrypted numbers)``, the numbers are kept for the reveal
+    """
+    return encrypt_random_numbers(*args)
+
+
+def sign_delivery(args):
+    """Job: build and sign a delivery transaction.
+
+    :param args: ``(sender, (nonce, gasprice, startgas, to, value, data))``
+    :returns: the rlp encoded signed transaction
+    """
+    sender, tx_args = args
+    tx = Transaction(*tx_args)
+    tx.sign(_privkeys[sender])
+    return rlp.encode(tx)
+
+
+class CryptoPool(object):
+
+    """
+    Runs crypto jobs for the RNO service.
+
+    With `num_workers` > 0 the jobs are executed by that many worker processes,
+    otherwise they are executed inline. `privkeys` are the keys deliveries can
+    be signed with.
+    """
+
+    def __init__(self, privkeys, num_workers=0):
+        self.num_workers = num_workers
+        if num_workers > 0:
+            log.info('starting crypto workers', num=num_workers)
+            self.pool = multiprocessing.Pool(num_workers, _init_worker, (privkeys,))
+        else:
+            self.pool = None
+            _init_worker(privkeys)
+
+    def map(self, func, jobs):
+        "applies `func` to all `jobs`, results are returned in the order of `jobs`"
+        if not jobs:
+            return []
+        if self.pool is None:
+            return map(func, jobs)
+        # wait for the workers in a thread so only the calling greenlet blocks
+        return gevent.get_hub().threadpool.apply(self.pool.map, (func, jobs))
+
+    def decode_signed(self, rlp_tx, sender):
+        "decodes a transaction returned by `sign_delivery` without recovering the sender"
+        tx = rlp.decode(rlp_tx, Transaction)
+        tx.sender = sender
+        return tx
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+class EntropyReservoir(object):
+
+    """
+    A bounded reservoir of entries from :func:`make_entropy`.
+
+    Whenever it holds less than `low` entries a background greenlet refills it
+    up to `high`, generating the entries with the crypto pool while the hub is
+    idle. Entries are removed when taken, so none is ever used twice. If the
+    reservoir is empty, :meth:`take` returns `None` and the encrypting job has
+    to generate the entry itself, which is counted as a miss.
+    """
+
+    refill_chunk = 16
+
+    def __init__(self, crypto_pool, low=64, high=256):
+        assert 0 <= low <= high
+        self.crypto_pool = crypto_pool
+        self.low = low
+        self.high = high
+        self.entries = deque()
+        self.hits = 0
+        self.misses = 0
+        self.refill_needed = Event()
+        self.refill_greenlet = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def take(self):
+        try:
+            entry = self.entries.popleft()
+            self.hits += 1
+        except IndexError:
+            entry = None
+            self.misses += 1
+        if len(self.entries) < self.low:
+            self.refill_needed.set()
+        return entry
+
+    def start(self):
+        if self.high > 0:
+            self.refill_needed.set()
+            self.refill_greenlet = gevent.spawn(self._refill)
+
+    def stop(self):
+        if self.refill_greenlet is not None:
+            self.refill_greenlet.kill()
+
+    def _refill(self):
+        while True:
+            self.refill_needed.wait()
+            while len(self.entries) < self.high:
+                gevent.idle()
+                num = min(self.refill_chunk, self.high - len(self.entries))
+                self.entries.extend(self.crypto_pool.map(make_entropy, [None] * num))
+            log.debug('entropy reservoir refilled', size=len(self.entries), hits=self.hits,
+                      misses=self.misses)
+            self.refill_needed.clear()
+
+
+class PubkeyCache(object):
+
+    """
+    LRU cache of recovered sender pubkeys.
+
+    A pubkey is stored under the sender's address and under the signing hash
+    and signature of the tx it was recovered from. The address is looked up
+    first if the sender of a tx is already known (i.e. it has been validated
+    before), the signing hash otherwise.
+    """
+
+    def __init__(self, crypto_pool, max_items=4096):
+        self.crypto_pool = crypto_pool
+        self.cache = LRUCache(max_items)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, tx):
+        "returns the cached pubkey of the sender of `tx` or `None`"
+        if tx._sender:  # only set if the sender has been recovered already
+            pubkey = self.cache.get(tx._sender)
+            if pubkey is not None:
+                return pubkey
+        return self.cache.get((signing_hash(tx), tx.v, tx.r, tx.s))
+
+    def add(self, tx, pubkey):
+        self.cache[(signing_hash(tx), tx.v, tx.r, tx.s)] = pubkey
+        self.cache[pubtoaddr(pubkey)] = pubkey
+
+    def recover(self, txs):
+        """Returns the sender pubkeys of `txs`, all cache misses are recovered
+        with a single call to the crypto pool.
+
+        :returns: a list of pubkeys in the order of `txs`, `None` for invalid
+                  signatures
+        """
+        pubkeys = [self.lookup(tx) for tx in txs]
+        missing = [i for i, pubkey in enumerate(pubkeys) if pubkey is None]
+        self.hits += len(txs) - len(missing)
+        self.misses += len(missing)
+        recovered = self.crypto_pool.map(recover_sender, [rlp.encode(txs[i]) for i in missing])
+        for i, pubkey in zip(missing, recovered):
+            if pubkey is not None:
+                self.add(txs[i], pubkey)
+                pubkeys[i] = pubkey
+        return pubkeys
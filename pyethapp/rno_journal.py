@@ -0,0 +1,196 @@
+"""
+Persistent journal of the RNO requests.
+
+Every request is journaled with its state, so work that was queued but not yet
+delivered survives a restart and a request that was answered already is never
+answered again. The numbers of a request are journaled once encrypted, so the
+numbers delivered after a restart are the ones that may have been handed out.
+
+Layout in the db::
+
+    'rno:req:' + request hash -> rlp([state, request, delivery hash, delivery,
+                                      numbers, encrypted numbers])
+    'rno:seg:' + seq          -> rlp([request hashes updated by commit seq])
+    'rno:segs'                -> rlp([first live seq, next seq])
+    'rno:height'              -> number of the last block scanned for requests
+
+Updates are buffered and written with a single db commit. Each commit writes a
+segment listing the requests it updated. A segment stays live as long as one
+of its requests is neither revealed nor dropped and the request was not updated
+by a later commit, so on startup only the live segments have to be read.
+"""
+import gevent
+import rlp
+from rlp.sedes import List, CountableList, big_endian_int, binary
+from ethereum.utils import sha3
+from ethereum.slogging import get_logger
+
+log = get_logger('rno.journal')
+
+RECEIVED, ENCRYPTED, DELIVERED, REVEALED, DROPPED = range(5)
+state_names = ('received', 'encrypted', 'delivered', 'revealed', 'dropped')
+# states in which a request needs no more work
+final_states = (REVEALED, DROPPED)
+
+record_sedes = List([big_endian_int, binary, binary, binary, binary, binary])
+segment_sedes = CountableList(binary)
+segments_sedes = List([big_endian_int, big_endian_int])
+
+
+class RNOJournal(object):
+
+    """
+    Write-ahead journal of the RNO requests stored in `db`.
+
+    Updates are committed every `commit_interval` seconds by a background
+    greenlet, or explicitly with :meth:`commit`.
+    """
+
+    prefix = 'rno:'
+
+    def __init__(self, db, commit_interval=1.):
+        self.db = db
+        self.commit_interval = commit_interval
+        self.dirty = dict()  # hash: record, not yet committed
+        self.segment_of = dict()  # hash: seq of the segment it was last written with
+        self.live = dict()  # seq: number of requests not revealed that were last written with seq
+        try:
+            self.first_seq, self.next_seq = rlp.decode(self.db.get(self.prefix + 'segs'),
+                                                       segments_sedes)
+        except KeyError:
+            self.first_seq = self.next_seq = 0
+        try:
+            self.height = big_endian_int.deserialize(self.db.get(self.prefix + 'height'))
+        except KeyError:
+            self.height = None
+        self.height_dirty = False
+        self.commit_greenlet = None
+
+    def _record_key(self, hash):
+        return self.prefix + 'req:' + hash
+
+    def _segment_key(self, seq):
+        return self.prefix + 'seg:' + str(seq)
+
+    def get(self, hash):
+        """Returns the record of a request or `None`, see the layout above for its
+        fields.
+        """
+        if hash in self.dirty:
+            return self.dirty[hash]
+        try:
+            return list(rlp.decode(self.db.get(self._record_key(hash)), record_sedes))
+        except KeyError:
+            return None
+
+    def __contains__(self, hash):
+        "whether the request `hash` is journaled and was not dropped"
+        record = self.get(hash)
+        return record is not None and record[0] != DROPPED
+
+    def received(self, tx):
+        """Journals the request `tx`. A dropped request is journaled again.
+
+        :returns: `False` if `tx` has been journaled before, `True` otherwise
+        """
+        if tx.hash in self:
+            return False
+        self.dirty[tx.hash] = [RECEIVED, rlp.encode(tx), '', '', '', '']
+        return True
+
+    def update(self, hash, state, delivery=None):
+        """Sets the state of a journaled request.
+
+        :param delivery: the rlp encoded delivery tx, `''` clears the delivery
+        """
+        record = self.get(hash)
+        if record is None:
+            log.warn('update of unknown request', hash=hash.encode('hex'))
+            return
+        record[0] = state
+        if delivery is not None:
+            record[2], record[3] = sha3(delivery) if delivery else '', delivery
+        self.dirty[hash] = record
+
+    def encrypted(self, hash, number, enc_num):
+        "journals the numbers of a request and sets its state to ENCRYPTED"
+        self.update(hash, ENCRYPTED)
+        record = self.dirty.get(hash)
+        if record is not None:
+            record[4], record[5] = number, enc_num
+
+    def set_height(self, number):
+        "records that the requests mined up to block `number` have been journaled"
+        self.height = number
+        self.height_dirty = True
+
+    def commit(self):
+        "writes all updates with a single commit of the db"
+        if self.height_dirty:
+            self.db.put(self.prefix + 'height', big_endian_int.serialize(self.height))
+            self.height_dirty = False
+            if not self.dirty:
+                self.db.commit()
+        if not self.dirty:
+            return
+        seq = self.next_seq
+        for hash, record in self.dirty.items():
+            self.db.put(self._record_key(hash), rlp.encode(record, record_sedes))
+            self._release(hash)
+            if record[0] not in final_states:
+                self.segment_of[hash] = seq
+                self.live[seq] = self.live.get(seq, 0) + 1
+        self.db.put(self._segment_key(seq), rlp.encode(self.dirty.keys(), segment_sedes))
+        self.next_seq += 1
+        # drop segments without live requests
+        while self.first_seq < self.next_seq and not self.live.get(self.first_seq):
+            self.live.pop(self.first_seq, None)
+            self.db.delete(self._segment_key(self.first_seq))
+            self.first_seq += 1
+        self.db.put(self.prefix + 'segs',
+                    rlp.encode([self.first_seq, self.next_seq], segments_sedes))
+        self.db.commit()
+        log.debug('journal committed', num=len(self.dirty), live_segments=len(self.live))
+        self.dirty.clear()
+
+    def _release(self, hash):
+        seq = self.segment_of.pop(hash, None)
+        if seq is not None:
+            self.live[seq] -= 1
+
+    def recover(self):
+        """Reads the live segments and returns the requests that still need work.
+
+        :returns: a list of ``(hash, record)`` in the order they were journaled
+        """
+        for seq in range(self.first_seq, self.next_seq):
+            try:
+                hashes = rlp.decode(self.db.get(self._segment_key(seq)), segment_sedes)
+            except KeyError:
+                continue
+            for hash in hashes:
+                self.segment_of[hash] = seq
+        pending = []
+        for hash, seq in sorted(self.segment_of.items(), key=lambda x: x[1]):
+            record = self.get(hash)
+            if record is None or record[0] in final_states:
+                del self.segment_of[hash]
+                continue
+            self.live[seq] = self.live.get(seq, 0) + 1
+            pending.append((hash, record))
+        log.info('journal recovered', pending=len(pending),
+                 segments=self.next_seq - self.first_seq)
+        return pending
+
+    def start(self):
+        self.commit_greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self.commit_greenlet is not None:
+            self.commit_greenlet.kill()
+        self.commit()
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.commit_interval)
+            self.commit()
@@ -0,0 +1,65 @@
+"""
+Merkle trees over the numbers of the RNO.
+
+Instead of publishing every number on its own, the RNO commits to a whole
+batch of numbers with the root of a Merkle tree. At reveal time the numbers are
+published together with their inclusion proofs, which are ``log2(n)`` hashes
+each and can be checked against the root with :func:`verify_proof`.
+
+Leaves and inner nodes are hashed with different prefixes, so a leaf can not be
+passed off as an inner node. A level with an odd number of nodes is padded with
+its last node.
+"""
+from ethereum.utils import sha3
+
+
+def leaf(request_hash, number):
+    "the leaf committing to `number`, answering the request `request_hash`"
+    return sha3('\x00' + request_hash + number)
+
+
+def node(left, right):
+    return sha3('\x01' + left + right)
+
+
+def merkle_tree(leaves):
+    """Builds the tree over the non empty list `leaves`.
+
+    :returns: the list of levels, ``levels[0]`` are the leaves, ``levels[-1]``
+              is ``[root]``
+    """
+    assert leaves
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([node(level[i], level[min(i + 1, len(level) - 1)])
+                       for i in range(0, len(level), 2)])
+    return levels
+
+
+def merkle_root(leaves):
+    return merkle_tree(leaves)[-1][0]
+
+
+def merkle_proof(levels, index):
+    "the inclusion proof of the leaf at `index`, a list of sibling hashes from the bottom up"
+    return [level[min((index >> depth) ^ 1, len(level) - 1)]
+            for depth, level in enumerate(levels[:-1])]
+
+
+def merkle_proofs(levels):
+    """The inclusion proofs of all leaves of the tree `levels`, in leaf order.
+
+    All proofs are read from the tree built once, so this is O(n log n) for n
+    leaves instead of building the tree once per proof.
+    """
+    return [merkle_proof(levels, i) for i in range(len(levels[0]))]
+
+
+def verify_proof(leaf_hash, index, proof, root):
+    "checks that `leaf_hash` is the leaf at `index` of the tree with `root`"
+    h = leaf_hash
+    for sibling in proof:
+        h = node(sibling, h) if index & 1 else node(h, sibling)
+        index >>= 1
+    return h == root
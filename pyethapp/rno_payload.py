@@ -0,0 +1,182 @@
+"""
+Payload of the RNO request and delivery transactions.
+
+A request transaction has empty data to request a single number, or the
+count of numbers requested as big endian integer, see :func:`request_count`.
+The numbers of a request are delivered together: `number` is then the
+encryption of the concatenated 64 byte numbers.
+
+Delivery payloads come in two formats:
+
+rlp (default)
+    ``rlp([version, when, publish_on, published_at, number])``, always in this
+    order, with the timestamps as big endian integers and the encrypted number
+    as raw bytes.
+json
+    the original format, a json object with the keys `when`, `publish_on`,
+    `published_at` and `number`. As json can not hold binary data, `number` is
+    hex encoded.
+
+A delivery answering several requests at once carries the list
+``[[requester, number], ...]`` instead of `number` (key `numbers` in json) and
+has version 2.
+
+With merkle commits enabled, the RNO additionally sends a commitment with
+version 3, ``rlp([version, when, publish_on, root, count])``, see rno_merkle.
+
+Clients can use :func:`decode_payload` for both formats and :func:`number_for`
+to find their number.
+"""
+import json
+import rlp
+from rlp.sedes import big_endian_int, binary, CountableList, List
+from ethereum import opcodes
+from ethereum.utils import big_endian_to_int
+
+PAYLOAD_VERSION = 1
+BATCH_PAYLOAD_VERSION = 2
+COMMIT_PAYLOAD_VERSION = 3
+PAYLOAD_FORMATS = ('rlp', 'json')
+
+
+class DeliveryPayload(rlp.Serializable):
+
+    """The content of a delivery transaction.
+
+    Payloads decoded from json have version 0.
+    """
+
+    fields = [
+        ('version', big_endian_int),
+        ('when', big_endian_int),
+        ('publish_on', big_endian_int),
+        ('published_at', binary),
+        ('number', binary)
+    ]
+
+
+class BatchDeliveryPayload(rlp.Serializable):
+
+    """The content of a delivery transaction answering several requests.
+
+    `numbers` is a list of ``[requester, number]``.
+    """
+
+    fields = [
+        ('version', big_endian_int),
+        ('when', big_endian_int),
+        ('publish_on', big_endian_int),
+        ('published_at', binary),
+        ('numbers', CountableList(List([binary, binary])))
+    ]
+
+
+class CommitPayload(rlp.Serializable):
+
+    """The content of a transaction committing to the `count` numbers revealed
+    at `publish_on`, with the merkle `root` over them.
+    """
+
+    fields = [
+        ('version', big_endian_int),
+        ('when', big_endian_int),
+        ('publish_on', big_endian_int),
+        ('root', binary),
+        ('count', big_endian_int)
+    ]
+
+
+payload_classes = {PAYLOAD_VERSION: DeliveryPayload, BATCH_PAYLOAD_VERSION: BatchDeliveryPayload,
+                   COMMIT_PAYLOAD_VERSION: CommitPayload}
+
+
+def encode_payload(payload, format='rlp'):
+    "encodes the payload `payload`, an instance of one of the `payload_classes`, as `format`"
+    if format == 'rlp':
+        return rlp.encode(payload)
+    elif format == 'json':
+        d = dict(when=payload.when, publish_on=payload.publish_on)
+        if isinstance(payload, CommitPayload):
+            d.update(root=payload.root.encode('hex'), count=payload.count)
+            return json.dumps(d)
+        d['published_at'] = payload.published_at
+        if isinstance(payload, BatchDeliveryPayload):
+            d['numbers'] = [[r.encode('hex'), n.encode('hex')] for r, n in payload.numbers]
+        else:
+            d['number'] = payload.number.encode('hex')
+        return json.dumps(d)
+    raise ValueError('unknown payload format: %r' % format)
+
+
+def decode_payload(data):
+    """Decodes the data of a delivery transaction.
+
+    :returns: an instance of one of the `payload_classes`
+    :raises: :exc:`ValueError` if `data` is not a supported payload
+    """
+    if data[:1] == '{':
+        try:
+            d = json.loads(data)
+            if 'root' in d:
+                return CommitPayload(0, d['when'], d['publish_on'], d['root'].decode('hex'),
+                                     d['count'])
+            args = [0, d['when'], d['publish_on'], str(d['published_at'])]
+            if 'numbers' in d:
+                numbers = [[r.decode('hex'), n.decode('hex')] for r, n in d['numbers']]
+                return BatchDeliveryPayload(*(args + [numbers]))
+            return DeliveryPayload(*(args + [d['number'].decode('hex')]))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('invalid json payload')
+    try:
+        items = rlp.decode(data)
+        version = big_endian_int.deserialize(items[0])
+    except (rlp.DecodingError, rlp.DeserializationError, IndexError, TypeError):
+        raise ValueError('invalid rlp payload')
+    if version not in payload_classes:
+        raise ValueError('unsupported payload version %d' % version)
+    try:
+        return payload_classes[version].deserialize(items)
+    except rlp.DeserializationError:
+        raise ValueError('invalid rlp payload')
+
+
+def number_for(payload, requester):
+    "returns the number in `payload` delivered to the address `requester` or `None`"
+    if isinstance(payload, CommitPayload):
+        return None
+    if isinstance(payload, BatchDeliveryPayload):
+        for r, number in payload.numbers:
+            if r == requester:
+                return number
+        return None
+    return payload.number
+
+
+def request_count(data, max_count):
+    """The number of random numbers requested by a request transaction with `data`.
+
+    :raises: :exc:`ValueError` if `data` is no count between 1 and `max_count`
+    """
+    if not data:
+        return 1
+    if len(data) > 4 or data[0] == '\x00':
+        raise ValueError('invalid request data')
+    count = big_endian_to_int(data)
+    if count > max_count:
+        raise ValueError('too many numbers requested: %d' % count)
+    return count
+
+
+def batch_entry_gas(requester, number, format='rlp'):
+    "the gas the entry ``[requester, number]`` adds to a batch delivery payload encoded as `format`"
+    if format == 'json':
+        data = json.dumps([requester.encode('hex'), number.encode('hex')]) + ', '
+    else:
+        data = rlp.encode([requester, number])
+    return intrinsic_gas(data) - opcodes.GTXCOST
+
+
+def intrinsic_gas(data):
+    "the gas a transaction with `data` costs before any code is executed"
+    return opcodes.GTXCOST + sum(opcodes.GTXDATAZERO if c == '\x00' else opcodes.GTXDATANONZERO
+                                 for c in data)
@@ -0,0 +1,269 @@
+"""
+Queues of RNO requests.
+
+Both queues are bounded and a requester can only hold a limited number of
+entries, so a single requester can not fill them.
+
+:class:`RequestQueue` serves the requests paying the highest gas price first.
+:class:`DRRQueue` serves the requesters in turn by deficit round robin, so a
+requester sending many requests can not starve the others.
+"""
+from bisect import insort
+from collections import OrderedDict, deque
+from itertools import count
+from Queue import Empty
+from rno_stats import monotonic
+
+
+def requester(tx):
+    """The address of the sender of `tx` if it is already known, `None` otherwise.
+
+    The sender is not recovered here, as this would be done in the caller's
+    greenlet. Transactions validated by the chain have their sender set.
+    """
+    return tx._sender or None
+
+
+class RequestQueue(object):
+
+    """
+    A bounded priority queue of request transactions, ordered by gas price.
+
+    Requests with the same gas price are served in arrival order. If the queue
+    is full, `drop_policy` decides which request is dropped:
+
+    lowest
+        the request with the lowest gas price, which may be the new one
+    newest
+        the new request
+    oldest
+        the request that has been waiting the longest
+
+    The number of requests per requester is only limited if the sender of the
+    request is known already. Queued requests dropped to make room are passed
+    to `drop_cb`.
+
+    :ivar dropped: number of requests dropped by reason (full, requester)
+    """
+
+    scheduling = 'priority'
+    drop_policies = ('lowest', 'newest', 'oldest')
+
+    def __init__(self, maxsize=4096, max_per_requester=256, drop_policy='lowest', drop_cb=None):
+        assert drop_policy in self.drop_policies, drop_policy
+        self.maxsize = maxsize
+        self.max_per_requester = max_per_requester
+        self.drop_policy = drop_policy
+        self.drop_cb = drop_cb
+        self.entries = []  # sorted list of (gasprice, -seq, tx, sender), best last
+        self.arrivals = OrderedDict()  # seq: (arrival time, entry), oldest first
+        self.per_requester = dict()  # requester: number of queued requests
+        self.dropped = dict(full=0, requester=0)
+        self.seq = count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def qsize(self):
+        return len(self.entries)
+
+    def empty(self):
+        return not self.entries
+
+    def full(self):
+        return len(self.entries) >= self.maxsize
+
+    def oldest_wait(self):
+        "seconds the oldest queued request has been waiting"
+        if not self.arrivals:
+            return 0.
+        arrived_at, _ = next(self.arrivals.itervalues())
+        return monotonic() - arrived_at
+
+    def put(self, tx, sender=None, cost=1):
+        """Adds `tx` to the queue, possibly dropping another request.
+
+        :param sender: the requester if known to the caller, see :func:`requester`
+        :param cost: the work the request causes, only used by :class:`DRRQueue`
+        :returns: `True` if `tx` was queued, `False` if it was dropped
+        """
+        sender = sender or requester(tx)
+        if sender is not None and self.per_requester.get(sender, 0) >= self.max_per_requester:
+            self.dropped['requester'] += 1
+            return False
+        entry = (tx.gasprice, -next(self.seq), tx, sender)
+        if self.full():
+            self.dropped['full'] += 1
+            if self.drop_policy == 'newest' or \
+                    (self.drop_policy == 'lowest' and entry < self.entries[0]):
+                return False
+            elif self.drop_policy == 'lowest':
+                self._drop(self.entries[0])
+            else:
+                _, oldest = next(self.arrivals.itervalues())
+                self._drop(oldest)
+        insort(self.entries, entry)
+        self.arrivals[-entry[1]] = (monotonic(), entry)
+        if sender is not None:
+            self.per_requester[sender] = self.per_requester.get(sender, 0) + 1
+        return True
+
+    def get(self):
+        """Removes and returns the request with the highest gas price.
+
+        :raises: :exc:`Queue.Empty` if the queue is empty
+        """
+        return self.get_with_arrival()[0]
+
+    def get_with_arrival(self):
+        "same as :meth:`get`, but returns ``(tx, arrival time)``, see :func:`monotonic`"
+        if not self.entries:
+            raise Empty()
+        entry = self.entries[-1]
+        arrived_at, _ = self.arrivals[-entry[1]]
+        self._remove(entry)
+        return entry[2], arrived_at
+
+    def _drop(self, entry):
+        self._remove(entry)
+        if self.drop_cb is not None:
+            self.drop_cb(entry[2])
+
+    def _remove(self, entry):
+        if entry is self.entries[-1]:
+            self.entries.pop()
+        elif entry is self.entries[0]:
+            self.entries.pop(0)
+        else:
+            self.entries.remove(entry)
+        del self.arrivals[-entry[1]]
+        sender = entry[3]
+        if sender is not None:
+            self.per_requester[sender] -= 1
+            if not self.per_requester[sender]:
+                del self.per_requester[sender]
+
+
+class DRRQueue(object):
+
+    """
+    A bounded queue of request transactions, served by deficit round robin
+    over the requesters.
+
+    Every requester has its own queue, served in arrival order. Active
+    requesters take turns, each turn adds `quantum` to the requester's deficit
+    and the requester is served as long as its deficit covers the cost of its
+    next request. With the cost being the numbers requested, every requester
+    gets the same share of numbers, no matter how many requests it sends.
+    Requests of unknown requesters share one queue.
+
+    If the queue is full, the newest request of the requester with the most
+    queued requests is dropped, which may be the new one. Queued requests
+    dropped are passed to `drop_cb`.
+
+    Has the same interface as :class:`RequestQueue`.
+    """
+
+    scheduling = 'drr'
+
+    def __init__(self, maxsize=4096, max_per_requester=256, quantum=1, drop_cb=None):
+        self.maxsize = maxsize
+        self.max_per_requester = max_per_requester
+        self.quantum = quantum
+        self.drop_cb = drop_cb
+        self.flows = dict()  # requester: deque of (seq, tx, cost), oldest first
+        self.deficits = dict()  # requester: deficit
+        self.active = deque()  # requesters with queued requests, the one served first
+        self.arrivals = OrderedDict()  # seq: arrival time, oldest first
+        self.dropped = dict(full=0, requester=0)
+        self.seq = count()
+
+    def __len__(self):
+        return len(self.arrivals)
+
+    def qsize(self):
+        return len(self.arrivals)
+
+    def empty(self):
+        return not self.arrivals
+
+    def full(self):
+        return len(self.arrivals) >= self.maxsize
+
+    def oldest_wait(self):
+        "seconds the oldest queued request has been waiting"
+        if not self.arrivals:
+            return 0.
+        return monotonic() - next(self.arrivals.itervalues())
+
+    def put(self, tx, sender=None, cost=1):
+        """Adds `tx` to the queue, possibly dropping another request.
+
+        :param sender: the requester if known to the caller, see :func:`requester`
+        :param cost: the work the request causes, e.g. the numbers requested
+        :returns: `True` if `tx` was queued, `False` if it was dropped
+        """
+        sender = sender or requester(tx)
+        flow = self.flows.get(sender)
+        if sender is not None and flow and len(flow) >= self.max_per_requester:
+            self.dropped['requester'] += 1
+            return False
+        if self.full():
+            self.dropped['full'] += 1
+            longest = max(self.flows, key=lambda s: len(self.flows[s]))
+            if len(flow or ()) + 1 > len(self.flows[longest]):
+                return False
+            seq, dropped, _ = self.flows[longest].pop()
+            del self.arrivals[seq]
+            if not self.flows[longest]:
+                self._deactivate(longest)
+            if self.drop_cb is not None:
+                self.drop_cb(dropped)
+            flow = self.flows.get(sender)
+        if flow is None:
+            flow = self.flows[sender] = deque()
+            self.deficits[sender] = 0
+            self.active.append(sender)
+            if len(self.active) == 1:
+                self.deficits[sender] += self.quantum
+        seq = next(self.seq)
+        flow.append((seq, tx, cost))
+        self.arrivals[seq] = monotonic()
+        return True
+
+    def get(self):
+        """Removes and returns the next request.
+
+        :raises: :exc:`Queue.Empty` if the queue is empty
+        """
+        return self.get_with_arrival()[0]
+
+    def get_with_arrival(self):
+        "same as :meth:`get`, but returns ``(tx, arrival time)``, see :func:`monotonic`"
+        if not self.arrivals:
+            raise Empty()
+        while True:
+            sender = self.active[0]
+            flow = self.flows[sender]
+            if self.deficits[sender] >= flow[0][2]:
+                break
+            self._next_turn()
+        seq, tx, cost = flow.popleft()
+        self.deficits[sender] -= cost
+        if not flow:
+            self._deactivate(sender)
+        return tx, self.arrivals.pop(seq)
+
+    def _next_turn(self):
+        self.active.rotate(-1)
+        self.deficits[self.active[0]] += self.quantum
+
+    def _deactivate(self, sender):
+        del self.flows[sender]
+        del self.deficits[sender]
+        if self.active[0] == sender:
+            self.active.popleft()
+            if self.active:
+                self.deficits[self.active[0]] += self.quantum
+        else:
+            self.active.remove(sender)
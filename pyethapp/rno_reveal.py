@@ -0,0 +1,167 @@
+"""
+Schedule of the RNO reveals.
+
+Every delivered number is revealed at its `publish_on` time. The schedule is
+kept in the db, grouped into buckets of `tick` seconds, so millions of reveals
+need neither a greenlet nor a timer each.
+
+Layout in the db::
+
+    'rno:reveals'               -> rlp([bucket, ...])
+    'rno:reveal:' + bucket      -> number of chunks of the bucket
+    'rno:reveal:' + bucket:i    -> rlp([[request hash, number, merkle root], ...])
+
+The merkle root is only present if the number was committed to with a merkle
+root, see rno_merkle.
+
+Each call to :meth:`RevealScheduler.schedule` appends one chunk to a bucket,
+so scheduling does not rewrite what is in the db already. A chunk is only
+rewritten to remove the entries of numbers whose delivery was rejected. On
+startup only the list of buckets is read.
+"""
+import heapq
+import time
+import gevent
+from gevent.event import Event
+import rlp
+from rlp.sedes import CountableList, big_endian_int, binary
+from ethereum.slogging import get_logger
+
+log = get_logger('rno.reveal')
+
+buckets_sedes = CountableList(big_endian_int)
+chunk_sedes = CountableList(CountableList(binary))
+
+
+class RevealScheduler(object):
+
+    """
+    Calls `reveal_cb` with the list of ``[request hash, number(, root)]``
+    entries that are due, once for all buckets due at the same time. Entries
+    scheduled together are passed in the order they were scheduled.
+
+    Buckets are kept in a heap by due time, so scheduling into a new bucket is
+    O(log n) and finding the due buckets is O(1) per bucket.
+    """
+
+    prefix = 'rno:reveal'
+
+    def __init__(self, db, reveal_cb, tick=60):
+        self.db = db
+        self.reveal_cb = reveal_cb
+        self.tick = tick
+        try:
+            self.buckets = list(rlp.decode(self.db.get(self.prefix + 's'), buckets_sedes))
+        except KeyError:
+            self.buckets = []
+        heapq.heapify(self.buckets)
+        self.num_chunks = dict()  # bucket: number of chunks, read from the db on first use
+        self.changed = Event()
+        self.greenlet = None
+        log.debug('reveal schedule loaded', buckets=len(self.buckets))
+
+    def _bucket_key(self, bucket):
+        return '%s:%d' % (self.prefix, bucket)
+
+    def _chunk_key(self, bucket, i):
+        return '%s:%d:%d' % (self.prefix, bucket, i)
+
+    def _get_num_chunks(self, bucket):
+        if bucket not in self.num_chunks:
+            try:
+                self.num_chunks[bucket] = big_endian_int.deserialize(
+                    self.db.get(self._bucket_key(bucket)))
+            except KeyError:
+                self.num_chunks[bucket] = 0
+        return self.num_chunks[bucket]
+
+    def _write_buckets(self):
+        self.db.put(self.prefix + 's', rlp.encode(self.buckets, buckets_sedes))
+
+    def due_time(self, bucket):
+        return bucket * self.tick
+
+    def bucket(self, publish_on):
+        return -(-publish_on // self.tick)  # rounded up, never reveal early
+
+    def schedule(self, publish_on, entries):
+        """Schedules the ``[request hash, number(, root)]`` `entries` to be
+        revealed at or shortly after the unix time `publish_on`.
+
+        The entries are written to the db, but not committed.
+
+        :returns: the chunk holding the entries, see :meth:`replace`
+        """
+        if not entries:
+            return None
+        bucket = self.bucket(publish_on)
+        i = self._get_num_chunks(bucket)
+        if i == 0:
+            heapq.heappush(self.buckets, bucket)
+            self._write_buckets()
+            if self.buckets[0] == bucket:
+                self.changed.set()  # new earliest bucket
+        self.db.put(self._chunk_key(bucket, i), rlp.encode(entries, chunk_sedes))
+        self.num_chunks[bucket] = i + 1
+        self.db.put(self._bucket_key(bucket), big_endian_int.serialize(i + 1))
+        return bucket, i
+
+    def replace(self, chunk, entries):
+        """Replaces the entries of a `chunk` returned by :meth:`schedule`, unless
+        it was revealed already. Not committed.
+        """
+        bucket, i = chunk
+        if i < self._get_num_chunks(bucket):
+            self.db.put(self._chunk_key(bucket, i), rlp.encode(entries, chunk_sedes))
+
+    def cancel(self, publish_on, hashes):
+        "removes the entries of the requests `hashes` scheduled at `publish_on`, not committed"
+        bucket = self.bucket(publish_on)
+        for i in range(self._get_num_chunks(bucket)):
+            entries = rlp.decode(self.db.get(self._chunk_key(bucket, i)), chunk_sedes)
+            kept = [e for e in entries if e[0] not in hashes]
+            if len(kept) < len(entries):
+                self.replace((bucket, i), kept)
+
+    def __len__(self):
+        "number of buckets"
+        return len(self.buckets)
+
+    def reveal_due(self, now=None):
+        "reveals all buckets that are due at `now` and returns the number of entries revealed"
+        now = now or time.time()
+        due = []
+        while self.buckets and self.due_time(self.buckets[0]) <= now:
+            due.append(heapq.heappop(self.buckets))
+        if not due:
+            return 0
+        entries = []
+        for bucket in due:
+            for i in range(self._get_num_chunks(bucket)):
+                entries.extend(rlp.decode(self.db.get(self._chunk_key(bucket, i)), chunk_sedes))
+        log.debug('revealing', buckets=len(due), num=len(entries))
+        self.reveal_cb(entries)
+        for bucket in due:
+            for i in range(self.num_chunks.pop(bucket)):
+                self.db.delete(self._chunk_key(bucket, i))
+            self.db.delete(self._bucket_key(bucket))
+        self._write_buckets()
+        self.db.commit()
+        return len(entries)
+
+    def start(self):
+        self.greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+
+    def _run(self):
+        while True:
+            self.changed.clear()
+            if self.buckets:
+                timeout = max(0, self.due_time(self.buckets[0]) - time.time())
+            else:
+                timeout = None
+            self.changed.wait(timeout)
+            self.reveal_due()
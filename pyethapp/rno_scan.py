@@ -0,0 +1,76 @@
+"""
+Scanner for the RNO requests mined into the chain.
+
+Requests mined while the node was down are never received live. On startup,
+and whenever the head changes, :class:`RequestScanner` searches the canonical
+blocks above the last journaled height for transactions sent to one of our
+identities.
+
+Blocks are read from the db in chunks and searched by the crypto pool's worker
+processes, so only one chunk of raw blocks is held in memory at a time. The
+workers only decode the transaction lists lazily and compare the recipients,
+the transactions found are returned rlp encoded, with their senders recovered.
+Transactions sent by one of the identities, i.e. our batch deliveries and
+commitments, are skipped.
+"""
+import gevent
+import rlp
+from ethereum.transactions import Transaction
+from ethereum.slogging import get_logger
+
+log = get_logger('rno.scan')
+
+
+def find_requests(args):
+    """Job: find the transactions of a block sent to one of `addrs`, but not sent by one.
+
+    :param args: ``(addrs, rlp_block)``
+    :returns: the list of ``(rlp encoded transaction, sender)`` found
+    """
+    addrs, rlp_block = args
+    found = []
+    for tx in rlp.decode_lazy(rlp_block)[1]:
+        if tx[3] in addrs:
+            rlp_tx = rlp.encode(list(tx))
+            sender = rlp.decode(rlp_tx, Transaction).sender
+            if sender not in addrs:
+                found.append((rlp_tx, sender))
+    return found
+
+
+class RequestScanner(object):
+
+    """
+    Scans blocks of `chain` for requests to `addrs` and passes the transactions
+    found to `found_cb`, in block order. `chunk_size` blocks are searched at
+    once.
+    """
+
+    def __init__(self, chain, crypto_pool, addrs, found_cb, chunk_size=256):
+        self.chain = chain
+        self.crypto_pool = crypto_pool
+        self.addrs = frozenset(addrs)
+        self.found_cb = found_cb
+        self.chunk_size = chunk_size
+
+    def get_rlp_block(self, number):
+        return self.chain.db.get(self.chain.index.get_block_by_number(number))
+
+    def scan(self, first, last):
+        """Scans the canonical blocks numbered `first` to `last`.
+
+        :returns: the number of requests found
+        """
+        found = 0
+        for start in range(first, last + 1, self.chunk_size):
+            numbers = range(start, min(start + self.chunk_size, last + 1))
+            jobs = [(self.addrs, self.get_rlp_block(n)) for n in numbers]
+            for txs in self.crypto_pool.map(find_requests, jobs):
+                for rlp_tx, sender in txs:
+                    tx = rlp.decode(rlp_tx, Transaction)
+                    tx.sender = sender
+                    self.found_cb(tx)
+                found += len(txs)
+            log.debug('scanned', first=numbers[0], last=numbers[-1], found=found)
+            gevent.sleep(0)  # let others run between chunks
+        return found
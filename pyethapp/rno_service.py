@@ -1,123 +1,890 @@
 # https://github.com/ethereum/go-ethereum/wiki/Blockpool
-import os
-import json
-from Queue import Queue
 from time import time
+from collections import OrderedDict
 
-from devp2p.crypto import privtopub, ECCx, encrypt, recover, _encode_sig
+import rlp
 from devp2p.service import BaseService
 from ethereum.transactions import Transaction
-from ethereum.processblock import apply_transaction
 from ethereum.utils import privtoaddr
 from ethereum.slogging import get_logger
+import gevent
 from gevent.event import Event
+from gevent.lock import Semaphore
+import rno_crypto
+import rno_merkle
+from rno_crypto import CryptoPool, EntropyReservoir, PubkeyCache
+from rno_queue import RequestQueue, DRRQueue
+from rno_journal import RNOJournal, ENCRYPTED, DELIVERED, REVEALED, DROPPED
+from rno_reveal import RevealScheduler
+from rno_scan import RequestScanner
+from rno_stats import RNOStats, monotonic
+from utils import LRUCache
+from rno_payload import (DeliveryPayload, BatchDeliveryPayload, CommitPayload, PAYLOAD_VERSION,
+                         BATCH_PAYLOAD_VERSION, COMMIT_PAYLOAD_VERSION, encode_payload,
+                         decode_payload, intrinsic_gas, batch_entry_gas, request_count)
 
 log = get_logger('rno')
 
+# order of the secp256k1 curve, signature values must be below it
+secpk1n = 115792089237316195423570985008687907852837564279074904382605163141518161494337
+
+
+class NonceManager(object):
+
+    """
+    Hands out consecutive nonces per sender address without reading the state
+    trie for every transaction, so many transactions of the same sender can be
+    in flight at once.
+
+    The nonce of an address is read from the head candidate when the address is
+    first used, so pending transactions are accounted for. It is raised to the
+    chain's value on every new head and reset if a transaction was rejected.
+
+    Allocated nonces are in flight until they are released. A reset waits for
+    all nonces of the address to be released, otherwise nonces still being
+    signed would be handed out again.
+    """
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.nonces = dict()  # addr: next nonce
+        self.in_flight = dict()  # addr: number of nonces allocated, but not released
+        self.stale = set()  # addrs to resync once no nonces are in flight
+
+    def allocate(self, addr, count=1):
+        "reserves `count` consecutive nonces for `addr` and returns the first one"
+        if addr not in self.nonces:
+            self.nonces[addr] = self.chain.head_candidate.get_nonce(addr)
+        nonce = self.nonces[addr]
+        self.nonces[addr] += count
+        self.in_flight[addr] = self.in_flight.get(addr, 0) + count
+        return nonce
+
+    def release(self, addr, count=1):
+        "marks `count` allocated nonces of `addr` as submitted, or rejected"
+        self.in_flight[addr] -= count
+        if not self.in_flight[addr]:
+            del self.in_flight[addr]
+            if addr in self.stale:
+                self.stale.remove(addr)
+                self.nonces[addr] = self.chain.head_candidate.get_nonce(addr)
+
+    def reject(self, addr):
+        "resyncs `addr` with the chain after one of its transactions was rejected"
+        if self.in_flight.get(addr):
+            self.stale.add(addr)
+        else:
+            self.nonces[addr] = self.chain.head_candidate.get_nonce(addr)
+
+    def on_new_head(self, block):
+        for addr, nonce in self.nonces.items():
+            self.nonces[addr] = max(nonce, block.get_nonce(addr))
+
+
+class DeliveryTracker(object):
+
+    """
+    Tracks the delivery transactions until they are mined.
+
+    Deliveries are indexed by hash, so a new head is checked in time linear in
+    its number of transactions. Deliveries not mined `resend_after` blocks after
+    they were sent are passed to `resend_cb` and tracked for another round.
+    """
+
+    def __init__(self, chain, resend_cb, resend_after=5):
+        self.chain = chain
+        self.resend_cb = resend_cb
+        self.resend_after = resend_after
+        self.outstanding = dict()  # hash: (tx, sent at, see rno_stats.monotonic)
+        self.sent_at_number = dict()  # head number: [hashes sent at that head]
+        self.resent = 0
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def add(self, tx):
+        self.outstanding[tx.hash] = (tx, monotonic())
+        self.sent_at_number.setdefault(self.chain.head.number, []).append(tx.hash)
+
+    def on_new_head(self, block):
+        "returns the confirmation times in seconds of the deliveries mined in `block`"
+        confirmed = []
+        if not self.outstanding:
+            return confirmed
+        for tx in block.get_transactions():
+            entry = self.outstanding.pop(tx.hash, None)
+            if entry is not None:
+                confirmed.append(monotonic() - entry[1])
+        limit = block.number - self.resend_after
+        for number in [n for n in self.sent_at_number if n <= limit]:
+            for hash in self.sent_at_number.pop(number):
+                if hash in self.outstanding:
+                    self.sent_at_number.setdefault(block.number, []).append(hash)
+                    self.resent += 1
+                    self.resend_cb(self.outstanding[hash][0])
+        return confirmed
+
+
+class RateLimiter(object):
+
+    """
+    Token buckets limiting the rate of an action per key.
+
+    Each key may take `rate` tokens per second on average and up to `burst`
+    tokens at once. The buckets of at most `max_keys` keys are kept, a key
+    evicted gets a full bucket again.
+    """
+
+    def __init__(self, rate, burst, max_keys=4096):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = LRUCache(max_keys)  # key: (tokens, updated at, see rno_stats.monotonic)
+
+    def take(self, key, tokens=1):
+        "takes `tokens` from the bucket of `key`, returns False if it holds too few"
+        now = monotonic()
+        available, updated_at = self.buckets.get(key, (self.burst, now))
+        available = min(self.burst, available + (now - updated_at) * self.rate)
+        if available < tokens:
+            self.buckets[key] = (available, now)
+            return False
+        self.buckets[key] = (available - tokens, now)
+        return True
+
+
+class RNOIdentity(object):
+
+    """A key pair the RNO serves requests for."""
+
+    def __init__(self, privkey):
+        self.privkey = privkey
+        self.addr = privtoaddr(privkey)
+
+
+class RNORequest(object):
+
+    """A request on its way through the RNO pipeline.
+
+    Requests not originating from a request transaction have no `tx` and `hash`.
+    """
+
+    def __init__(self, tx, rno_addr=None, received_at=None):
+        self.tx = tx
+        # when the request was added, see rno_stats.monotonic
+        self.received_at = received_at
+        self.hash = tx.hash if tx else None
+        # the identity the request was addressed to
+        self.rno_addr = tx.to if tx else rno_addr
+        self.pubkey = None
+        # the address the number is delivered to
+        self.requester = None
+        # the number of numbers requested
+        self.count = 1
+        self.enc_num = None
+        # the plain numbers, revealed at publish_on
+        self.number = None
+        # the signed delivery transaction
+        self.delivery = None
+
+
+class DeliveryBatcher(object):
+
+    """
+    Collects the answered requests of each identity into batches of up to
+    `size` requests, which are delivered with a single transaction.
+
+    The data of a delivery costs gas, so a batch is also full once the gas of
+    its requests, see `gas_cb`, would exceed `max_gas_cb()`.
+
+    A batch is passed to `flush_cb` at the latest `window` seconds after its
+    first request was added, so batching delays a delivery by at most `window`.
+    """
+
+    def __init__(self, flush_cb, size, window, gas_cb, max_gas_cb):
+        self.flush_cb = flush_cb
+        self.size = size
+        self.window = window
+        self.gas_cb = gas_cb
+        self.max_gas_cb = max_gas_cb
+        self.batches = dict()  # rno_addr: [requests]
+        self.gas = dict()  # rno_addr: gas of the requests batched
+        self.deadlines = dict()  # rno_addr: greenlet flushing the batch
+
+    def add(self, request):
+        "adds `request` and returns the list of batches that are full"
+        addr = request.rno_addr
+        gas = self.gas_cb(request)
+        full = []
+        if addr in self.batches and self.gas[addr] + gas > self.max_gas_cb():
+            full.append(self._pop(addr))  # the request starts the next batch
+        batch = self.batches.setdefault(addr, [])
+        batch.append(request)
+        self.gas[addr] = self.gas.get(addr, 0) + gas
+        if len(batch) >= self.size:
+            full.append(self._pop(addr))
+        elif len(batch) == 1:
+            self.deadlines[addr] = gevent.spawn_later(self.window, self.flush, addr)
+        return full
+
+    def _pop(self, addr):
+        deadline = self.deadlines.pop(addr, None)
+        if deadline is not None and deadline is not gevent.getcurrent():
+            deadline.kill()
+        self.gas.pop(addr, None)
+        return self.batches.pop(addr, None)
+
+    def flush(self, addr):
+        batch = self._pop(addr)
+        if batch:
+            self.flush_cb([batch])
+
+    def flush_all(self):
+        batches = [self._pop(addr) for addr in self.batches.keys()]
+        if batches:
+            self.flush_cb(batches)
+
 
 class RNOService(BaseService):
 
     # required by BaseService
     name = 'rno'
-    default_config = dict(eth=dict(privkey_hex=''))
+    # crypto_workers: number of processes doing the ECC work, 0 runs it inline
+    # reservoir_low/high: watermarks of the pre-generated numbers and ephemeral keys
+    # pubkey_cache_size: max number of entries in the recovered pubkeys cache
+    # privkeys_hex: additional keys to serve requests for, next to eth.privkey_hex
+    # payload_format: 'rlp' or 'json', see rno_payload
+    # scheduling: 'drr' serves the requesters in turn, 'priority' by gas price, see rno_queue
+    # queue_size, max_per_requester, drop_policy: limits of the request queue, see rno_queue.
+    #   drop_policy only applies to the priority queue.
+    # min_gasprice, fee_per_number: requests paying a lower gas price or a value below
+    #   fee_per_number per number requested are not admitted
+    # journal_commit_interval: seconds between the batched commits of the journal
+    # batch_size, batch_window: deliver up to batch_size numbers with one transaction,
+    #   waiting at most batch_window seconds for a batch to fill up. 1 disables batching.
+    # workers: number of greenlets consuming the request queue
+    # worker_batch_size: max number of requests a worker takes from the queue at once
+    # reveal_delay: seconds between the delivery and the reveal of a number
+    # reveal_tick: resolution of the reveal schedule in seconds, see rno_reveal
+    # max_numbers_per_request: max count a request may ask for, see rno_payload
+    # resend_after: number of blocks after which a delivery not mined is broadcasted again
+    # anchor_batch_size, anchor_window: the numbers of off chain requests are anchored
+    #   on chain in batches of up to anchor_batch_size, sent at least every anchor_window
+    # scan_chunk_size: number of blocks searched at once for mined requests, see rno_scan
+    # merkle_commit: commit to the numbers delivered together with a merkle root on
+    #   chain and reveal them as a batch with inclusion proofs, see rno_merkle
+    # offchain_rate, offchain_total_rate: numbers per second that may be requested off
+    #   chain by a requester, and by all requesters. Their fee is not paid on chain.
+    default_config = dict(eth=dict(privkey_hex=''),
+                          rno=dict(crypto_workers=0, reservoir_low=64, reservoir_high=256,
+                                   pubkey_cache_size=4096, privkeys_hex=[],
+                                   payload_format='rlp', queue_size=4096,
+                                   max_per_requester=256, drop_policy='lowest',
+                                   journal_commit_interval=1., batch_size=1,
+                                   batch_window=.5, workers=4, worker_batch_size=64,
+                                   reveal_delay=86400, reveal_tick=60,
+                                   max_numbers_per_request=256, scan_chunk_size=256,
+                                   anchor_batch_size=256, anchor_window=10.,
+                                   resend_after=5, merkle_commit=False, scheduling='drr',
+                                   min_gasprice=0, fee_per_number=0, offchain_rate=1.,
+                                   offchain_total_rate=64.))
 
     # RNO address, where the requests for random number should be addressed to.
     my_addr = None
 
-    # Keeps all transactions not yet processed by loop_body
-    tx_queue = None
+    # All identities served by this node, by address. Requests may be sent to any of them.
+    identities = None
 
-    # Will be used to a) sign transaction and b) encrypt random number using ECIES
-    eccx = None
+    # Keeps all transactions not yet processed by loop_body, best paying first
+    tx_queue = None
 
     privkey_hex = None
 
+    # Does the pubkey recovery, encryption and signing off the gevent hub
+    crypto_pool = None
+
+    # Random numbers and ephemeral keys generated ahead of the requests
+    reservoir = None
+
+    # Nonces of the delivery transactions
+    nonces = None
+
+    # Recovers the requesters' pubkeys, recovering each only once
+    pubkeys = None
+
+    # Records the state of every request, survives restarts
+    journal = None
+
+    # Timings and error counts of the pipeline
+    stats = None
+
+    # Collects deliveries into batches, None if batching is disabled
+    batcher = None
+
+    # Keeps the deliveries sent until they are mined
+    tracker = None
+
+    # Collects the answered off chain requests, which are anchored on chain in batches
+    anchors = None
+
+    # Greenlets consuming tx_queue
+    workers = None
+
+    # Reveals the delivered numbers at their publish_on time
+    reveals = None
+
+    # Finds the requests mined into the chain
+    scanner = None
+
+    # Limit the numbers requested off chain, per requester and in total
+    requester_limit = None
+    offchain_limit = None
+
+    # Share of the block gas limit a delivery transaction may use
+    max_delivery_gas_share = 0.5
+
     def __init__(self, app):
         super(RNOService, self).__init__(app)
         log.info('Initializing RNO')
         self.config = app.config
-        self.interrupt = Event()
-        self.tx_queue = Queue()  # thread safe
+        # set whenever a request is queued, workers wait for it if the queue is empty
+        self.requests_available = Event()
+        # set on every new head, wakes up the scanner
+        self.head_changed = Event()
+        self.scan_greenlet = None
+        self.stopping = False
+        # batches of requests whose delivery was rejected, see undeliver
+        self.undelivered = []
+        self.workers = []
+        if self.config['rno']['scheduling'] == 'drr':
+            # one turn is worth the largest request, so every requester is served each round
+            self.tx_queue = DRRQueue(self.config['rno']['queue_size'],
+                                     self.config['rno']['max_per_requester'],
+                                     self.config['rno']['max_numbers_per_request'],
+                                     self.drop_request)
+        else:
+            self.tx_queue = RequestQueue(self.config['rno']['queue_size'],
+                                         self.config['rno']['max_per_requester'],
+                                         self.config['rno']['drop_policy'], self.drop_request)
         self.privkey_hex = self.config['eth']['privkey_hex'].decode('hex')
         self.my_addr = privtoaddr(self.privkey_hex)
-        self.eccx = ECCx(None, self.privkey_hex)
+        self.identities = dict()
+        privkeys = [self.privkey_hex] + [k.decode('hex') for k in self.config['rno']['privkeys_hex']]
+        for privkey in privkeys:
+            identity = RNOIdentity(privkey)
+            self.identities[identity.addr] = identity
+        log.info('serving RNO addresses', addrs=[a.encode('hex') for a in self.identities])
+        # held while an identity's deliveries are signed and submitted, see send_deliveries
+        self.sender_locks = dict((addr, Semaphore()) for addr in self.identities)
+        self.crypto_pool = CryptoPool([i.privkey for i in self.identities.values()],
+                                      self.config['rno']['crypto_workers'])
+        self.reservoir = EntropyReservoir(self.crypto_pool, self.config['rno']['reservoir_low'],
+                                          self.config['rno']['reservoir_high'])
+        self.pubkeys = PubkeyCache(self.crypto_pool, self.config['rno']['pubkey_cache_size'])
+        chainservice = self.app.services.chain
+        self.nonces = NonceManager(chainservice.chain)
+        chainservice.on_new_head_cbs.append(self.nonces.on_new_head)
+        self.tracker = DeliveryTracker(chainservice.chain, chainservice.resend_transaction,
+                                       self.config['rno']['resend_after'])
+        chainservice.on_new_head_cbs.append(self.on_new_head)
+        self.journal = RNOJournal(self.app.services.db,
+                                  self.config['rno']['journal_commit_interval'])
+        self.reveals = RevealScheduler(self.app.services.db, self.reveal,
+                                       self.config['rno']['reveal_tick'])
+        self.scanner = RequestScanner(chainservice.chain, self.crypto_pool, self.identities.keys(),
+                                      self.add_mined_transaction,
+                                      self.config['rno']['scan_chunk_size'])
+        self.stats = RNOStats()
+        # a requester may always ask for one request's worth of numbers at once
+        rate = self.config['rno']['offchain_rate']
+        total_rate = self.config['rno']['offchain_total_rate']
+        max_count = self.config['rno']['max_numbers_per_request']
+        self.requester_limit = RateLimiter(rate, max(max_count, rate * 60))
+        self.offchain_limit = RateLimiter(total_rate, max(max_count, total_rate * 60), 1)
+        if self.config['rno']['batch_size'] > 1:
+            self.batcher = DeliveryBatcher(self.send_deliveries, self.config['rno']['batch_size'],
+                                           self.config['rno']['batch_window'],
+                                           self.delivery_gas, self.max_delivery_gas)
+        self.anchors = DeliveryBatcher(self.send_deliveries,
+                                       self.config['rno']['anchor_batch_size'],
+                                       self.config['rno']['anchor_window'],
+                                       self.delivery_gas, self.max_delivery_gas)
 
-    # Process the transaction queue. There is no concurrency problem here since
-    # the Queue is thread-safe.
-    def loop_body(self):
+    # Process the transaction queue, taking at most max_requests. There is no
+    # concurrency problem here since the queue is only accessed from greenlets.
+    def loop_body(self, max_requests=None):
         log.debug('RNO body', my_addr=self.my_addr)
-        while not self.tx_queue.empty():
-            tx = self.tx_queue.get()
-            if tx.to == self.my_addr:
-                self.process_tx(tx)
+        txs, arrivals = [], []
+        while not self.tx_queue.empty() and len(txs) != max_requests:
+            tx, arrived_at = self.tx_queue.get_with_arrival()
+            txs.append(tx)
+            arrivals.append(arrived_at)
+        self.process_txs(txs, arrivals)
 
     # Transactions should be added to a queue so that 'loop_body' process that queue
     # To minimize code dependency and coupling, this method will be called for ALL
     # transactions received.
     # It is called in the loop of eth_service.py -> on_receive_transactions
     def add_transaction(self, tx):
+        # Only transactions addressed to one of our identities are queued. The
+        # lookup is a dict access, so the caller's thread is not blocked.
+        if tx.to not in self.identities or self.stopping:
+            return
+        # our batch deliveries and commitments are sent to ourselves
+        if tx._sender in self.identities:
+            return
         log.debug('RNO received transaction', tx=tx)
-        # All transactions are being queued here to minimize the blocking
-        # of caller's thread. Transactions not addressed to RNO are discarded
-        # in loop_body.
-        self.tx_queue.put(tx)
+        if tx.hash in self.journal:
+            log.debug('RNO request known', tx=tx)
+            return
+        try:
+            count = self.admit(tx)
+        except ValueError as e:
+            log.debug('RNO request not admitted', tx=tx, error=e)
+            self.stats.add_error('inadmissible')
+            return
+        # the requester is only known if its pubkey is cached, the others share a turn
+        pubkey = self.pubkeys.lookup(tx)
+        sender = rno_crypto.pubtoaddr(pubkey) if pubkey else None
+        if not self.tx_queue.put(tx, sender, count):
+            log.debug('RNO request dropped', tx=tx, dropped=self.tx_queue.dropped)
+        else:
+            self.journal.received(tx)
+            self.requests_available.set()
+
+    # Journals a queued request that was dropped, so it is not recovered and is
+    # taken again if it is sent again.
+    def drop_request(self, tx):
+        log.debug('RNO request dropped', tx=tx)
+        self.journal.update(tx.hash, DROPPED)
+
+    # Cheap checks done before a request is queued, so no crypto work is spent
+    # on malformed or underpaid requests. Returns the number of numbers requested
+    # and raises ValueError if the request is not admitted.
+    def admit(self, tx):
+        count = request_count(tx.data, self.config['rno']['max_numbers_per_request'])
+        if tx.gasprice < self.config['rno']['min_gasprice']:
+            raise ValueError('gas price too low')
+        if tx.value < count * self.config['rno']['fee_per_number']:
+            raise ValueError('fee too low')
+        if tx.v not in (27, 28) or not 0 < tx.r < secpk1n or not 0 < tx.s < secpk1n:
+            raise ValueError('invalid signature values')
+        return count
+
+    # Adds a request found in a block. Waits for the queue to make room, as
+    # many old requests may be found at once.
+    def add_mined_transaction(self, tx):
+        while self.tx_queue.full() and not self.stopping:
+            gevent.sleep(0.01)
+        self.add_transaction(tx)
+
+    def on_new_head(self, block):
+        for latency in self.tracker.on_new_head(block):
+            self.stats.add_confirmation(latency)
+        if self.undelivered and not self.stopping:
+            gevent.spawn(self.redeliver)
+        self.head_changed.set()
+
+    # Feeds the requests mined since the last journaled height into the queue,
+    # first catching up with the blocks mined while we were down, then following
+    # the head. The height is committed with the requests found.
+    def _scan(self):
+        chain = self.app.services.chain.chain
+        if self.journal.height is None:  # first start, requests sent before are not answered
+            self.journal.set_height(chain.head.number)
+        while True:
+            self.head_changed.clear()
+            last = chain.head.number
+            # a head at or below the height is a reorg, its block may be new
+            first = min(self.journal.height + 1, last)
+            found = self.scanner.scan(first, last)
+            if found or last - first > 1:
+                log.info('scanned for mined requests', first=first, last=last, found=found)
+            self.journal.set_height(last)
+            self.head_changed.wait()
 
     # This method is the core of the RNO. Transactions should NOT be processed in the
     # add_transaction otherwise it would block the caller.
     def process_tx(self, tx):
-        log.debug('process tx', tx=tx)
+        self.process_txs([tx])
+
+    # Processes a batch of requests. The crypto work is done by the crypto pool,
+    # results come back in the order of txs. arrivals are the times the txs were
+    # added (see rno_stats.monotonic) and default to now.
+    def process_txs(self, txs, arrivals=None):
+        if not txs:
+            return
+        log.debug('process txs', num=len(txs))
+        arrivals = arrivals or [monotonic()] * len(txs)
+
+        # 1) read the number of numbers requested, before any crypto is done
+        requests = []
+        max_count = self.config['rno']['max_numbers_per_request']
+        for tx, arrived_at in zip(txs, arrivals):
+            request = RNORequest(tx, received_at=arrived_at)
+            try:
+                request.count = request_count(tx.data, max_count)
+            except ValueError as e:
+                log.warn('dropping invalid request', tx=tx, error=e)
+                self.stats.add_error('invalid')
+                self.journal.update(tx.hash, DROPPED)
+                continue
+            requests.append(request)
 
         # 2) Extract sender's pubkey from the Electrum-style signature of the tx
-        sender_pubkey = self.sender_pubkey_from_tx(tx)
-        enc_num = self.generate_encrypted_random_number(sender_pubkey)
+        started_at = monotonic()
+        pubkeys = self.pubkeys.recover([r.tx for r in requests])
+        self.stats.add_stage('recover', started_at, len(requests))
+        recovered = []
+        for request, pubkey in zip(requests, pubkeys):
+            if pubkey is None:
+                log.warn('dropping invalid request', tx=request.tx)
+                self.stats.add_error('invalid')
+                self.journal.update(request.hash, DROPPED)
+                continue
+            request.pubkey = pubkey
+            request.requester = rno_crypto.pubtoaddr(pubkey)
+            recovered.append(request)
+        requests = recovered
+
+        # 3) generate the random numbers and 4) encrypt them (eRN1), all numbers
+        # of a request in a single encryption
+        started_at = monotonic()
+        jobs = [(r.pubkey, self.reservoir.take(), r.count) for r in requests]
+        for request, (number, enc_num) in zip(requests,
+                                              self.crypto_pool.map(rno_crypto.encrypt_number,
+                                                                   jobs)):
+            request.number, request.enc_num = number, enc_num
+            self.journal.encrypted(request.hash, number, enc_num)
+        self.stats.add_stage('encrypt', started_at, len(requests))
 
         # 5) encrypt RN using reveal host's pubkey (eRN2) (???)
         # this is not specified yet
 
         # 6) create/send transaction back to tx sender
-        self.deliver(enc_num, tx.sender)
+        self.deliver_many(requests)
 
-        # 7) create/send transaction to reveal host.
-        # this is not specified yet
+        # 7) the numbers are revealed at publish_on, see reveal
+
+    # Answers the request tx received off chain, see jsonrpc.RNO.request. It is
+    # journaled like any other request, but the encrypted numbers are returned
+    # at once and delivered on chain later, batched with other off chain requests.
+    # Raises ValueError if the request is invalid.
+    #
+    # The request is never mined, so its fee is not paid and the RNO pays for
+    # anchoring it. The numbers requested off chain are therefore rate limited,
+    # per requester and in total.
+    def request(self, tx):
+        if tx.to not in self.identities:
+            raise ValueError('request not addressed to this RNO')
+        if self.stopping:
+            raise ValueError('RNO is stopping')
+        if tx.hash in self.journal:
+            raise ValueError('known request')
+        request = RNORequest(tx)
+        request.count = self.admit(tx)
+        if not self.offchain_limit.take(None, request.count):
+            self.stats.add_error('rate_limited')
+            raise ValueError('rate limit exceeded')
+
+        started_at = monotonic()
+        request.pubkey = self.pubkeys.recover([tx])[0]
+        if request.pubkey is None:
+            self.stats.add_error('invalid')
+            raise ValueError('invalid signature')
+        request.requester = rno_crypto.pubtoaddr(request.pubkey)
+        self.stats.add_stage('recover', started_at, 1)
+        if not self.requester_limit.take(request.requester, request.count):
+            self.stats.add_error('rate_limited')
+            raise ValueError('rate limit exceeded for requester')
+
+        started_at = monotonic()
+        job = (request.pubkey, self.reservoir.take(), request.count)
+        request.number, request.enc_num = self.crypto_pool.map(rno_crypto.encrypt_number, [job])[0]
+        self.stats.add_stage('encrypt', started_at, 1)
+
+        if not self.journal.received(tx):  # received concurrently
+            raise ValueError('known request')
+        self.journal.encrypted(tx.hash, request.number, request.enc_num)
+        # the number must not be handed out before it is journaled
+        self.journal.commit()
+        batches = self.anchors.add(request)
+        if batches:  # don't delay the reply
+            gevent.spawn(self.send_deliveries, batches)
+        return request.enc_num
 
     def sender_pubkey_from_tx(self, tx):
-        encoded_signature = _encode_sig(tx.v, tx.r, tx.s)
-        message = None  # TODO: find out how to build the data (message) where the signature is applied.
-        return recover(message, encoded_signature)
+        return self.pubkeys.recover([tx])[0]
 
     def generate_encrypted_random_number(self, pubkey):
-        # 3) generate the random number
-        number = os.urandom(64)
+        return rno_crypto.encrypt_random_number(pubkey, self.reservoir.take())
+
+    def deliver(self, enc_num, to, sender=None):
+        request = RNORequest(None, sender or self.my_addr)
+        request.requester, request.enc_num = to, enc_num
+        self.deliver_many([request])
+
+    # Delivers the numbers of the requests, either with a transaction per request
+    # or in batches if batching is enabled.
+    def deliver_many(self, requests):
+        if self.batcher is None:
+            batches = [[r] for r in requests]
+        else:
+            batches = [batch for r in requests for batch in self.batcher.add(r)]
+        self.send_deliveries(batches)
+
+    # The gas the entry of an answered request adds to the data of a batch delivery.
+    def delivery_gas(self, request):
+        return batch_entry_gas(request.requester, request.enc_num,
+                               self.config['rno']['payload_format'])
+
+    # The gas the entries of a batch delivery may use. A delivery uses at most
+    # max_delivery_gas_share of the block gas limit, so it still fits into a block
+    # with other transactions.
+    def max_delivery_gas(self):
+        gas_limit = self.app.services.chain.chain.head_candidate.gas_limit
+        base_gas = intrinsic_gas(self.delivery_payload([]))
+        return int(gas_limit * self.max_delivery_gas_share) - base_gas
 
-        # 4) encrypt RN using sender's pubkey (eRN1)
-        return self.eccx.encrypt(number, pubkey)
+    # Signs and submits a delivery transaction for each batch of requests. It is
+    # sent by the identity the requests were addressed to. With merkle_commit,
+    # one more transaction commits to the numbers delivered, see rno_merkle.
+    def send_deliveries(self, batches):
+        if not batches:
+            return
+        when = int(round(time()))
+        publish_on = when + self.config['rno']['reveal_delay']
+        messages = []  # (sender, to, data)
+        for batch in batches:
+            sender = batch[0].rno_addr
+            # a single delivery is sent to the requester, a batch to ourself
+            to = batch[0].requester if len(batch) == 1 else sender
+            messages.append((sender, to, self.delivery_payload(batch, when, publish_on)))
+        commit = self.config['rno']['merkle_commit'] and \
+            any(r.number for b in batches for r in b)
 
-    def deliver(self, enc_num, to):
         # nonce = number of transactions already sent by that account
-        head = self.app.services.chain.chain.head
-        nonce = head.get_nonce(self.my_addr)
+        counts = dict()
+        for sender, _, _ in messages:
+            counts[sender] = counts.get(sender, 0) + 1
+        if commit:  # the commitment follows the deliveries
+            counts[self.my_addr] = counts.get(self.my_addr, 0) + 1
+        # Deliveries are sent concurrently, by the workers and the batchers. A sender's
+        # lock is held from the nonce allocation to the last submit, so its transactions
+        # are submitted in nonce order. Locks are taken in address order.
+        locks = [self.sender_locks[sender] for sender in sorted(counts)]
+        for lock in locks:
+            lock.acquire()
+        nonces = dict()
+        submitted = False
+        try:
+            for sender, count in counts.items():
+                nonces[sender] = self.nonces.allocate(sender, count)
+            self._sign_and_submit(batches, messages, nonces, when, publish_on, commit)
+            submitted = True
+        finally:
+            for sender in nonces:
+                if not submitted:  # the nonces not submitted would leave a gap
+                    self.nonces.reject(sender)
+                self.nonces.release(sender, counts[sender])
+            for lock in locks:
+                lock.release()
 
+    # Signs the messages with consecutive nonces starting at nonces[sender],
+    # journals and submits them. The numbers are revealed and committed to only
+    # if their delivery was accepted.
+    def _sign_and_submit(self, batches, messages, nonces, when, publish_on, commit):
+        nonces = dict(nonces)
+        jobs = []
+        for sender, to, data in messages:
+            jobs.append(self._signing_job(sender, nonces[sender], to, data))
+            nonces[sender] += 1
+
+        num_requests = sum(len(b) for b in batches)
+        started_at = monotonic()
+        signed = self.crypto_pool.map(rno_crypto.sign_delivery, jobs)
+        txs = [self.crypto_pool.decode_signed(rlp_tx, sender)
+               for rlp_tx, (sender, _, _) in zip(signed, messages)]
+        for batch, delivery, rlp_tx in zip(batches, txs, signed):
+            for request in batch:
+                request.delivery = delivery
+                if request.hash:
+                    self.journal.update(request.hash, DELIVERED, rlp_tx)
+        self.stats.add_stage('sign', started_at, num_requests)
+        reveals = [[r.hash or '', r.number] for b in batches for r in b if r.number]
+        chunk = self.reveals.schedule(publish_on, reveals)
+
+        # the deliveries and reveals must be journaled before they are sent, otherwise a
+        # request could be answered twice after a crash
+        self.journal.commit()
+        started_at = monotonic()
+        accepted, rejected = [], []
+        for batch, tx in zip(batches, txs):
+            if not self.submit(tx):
+                rejected.append(batch)
+                continue
+            accepted.append(batch)
+            for request in batch:  # only accepted deliveries count as delivered
+                if request.received_at is not None:
+                    self.stats.add_latency(request.received_at)
+        self.stats.add_stage('apply', started_at, num_requests)
+        if not rejected and not commit:
+            return
+
+        # the numbers of the rejected deliveries are delivered again, with a new publish_on
+        for batch in rejected:
+            self.undeliver(batch)
+        reveals = [[r.hash or '', r.number] for b in accepted for r in b if r.number]
+        if commit:
+            if reveals:
+                self.commit_reveals(reveals, nonces[self.my_addr], when, publish_on)
+            else:
+                self.nonces.reject(self.my_addr)  # the nonce of the commitment is not used
+        if chunk is not None:
+            self.reveals.replace(chunk, reveals)
+        self.journal.commit()
+
+    # The job signing a transaction of sender with nonce, see rno_crypto.sign_delivery.
+    def _signing_job(self, sender, nonce, to, data):
         # Took from buterin example:
         # https://blog.ethereum.org/2014/04/10/pyethereum-and-serpent-programming-guide/
         gasprice = 10**12
 
-        # Took from buterin example:
-        # https://blog.ethereum.org/2014/04/10/pyethereum-and-serpent-programming-guide/
-        startgas = 10000
         value = 0  # It's just a message, don't need to send any value (TODO: confirm that info)
 
-        # data is a json formatted message but has to be 'binary'
-        unix_now = int(round(time()))
-        payload = {}
-        payload['when'] = unix_now
-        payload['number'] = enc_num
-        payload['publish_on'] = unix_now + 86400  # in 24 hours
-        payload['published_at'] = 'http://www.example.com/foo'
-        data = json.dumps(payload)
+        # no code is run at the receiving address, so the intrinsic gas is enough
+        startgas = intrinsic_gas(data)
+        return sender, (nonce, gasprice, startgas, to, value, data)
 
-        deliver_tx = Transaction(nonce, gasprice, startgas, to, value, data)
-        signed_deliver_tx = deliver_tx.sign(self.privkey_hex)
-        success, output = apply_transaction(head, signed_deliver_tx)
+    # Commits to the numbers of the reveal entries with a merkle root sent on
+    # chain with the nonce reserved for it. The root is appended to the entries
+    # if the commitment was accepted, otherwise the numbers are revealed without.
+    def commit_reveals(self, entries, nonce, when, publish_on):
+        root = rno_merkle.merkle_root([rno_merkle.leaf(*e) for e in entries])
+        payload = CommitPayload(version=COMMIT_PAYLOAD_VERSION, when=when,
+                                publish_on=publish_on, root=root, count=len(entries))
+        data = encode_payload(payload, self.config['rno']['payload_format'])
+        job = self._signing_job(self.my_addr, nonce, self.my_addr, data)
+        rlp_tx = self.crypto_pool.map(rno_crypto.sign_delivery, [job])[0]
+        if self.submit(self.crypto_pool.decode_signed(rlp_tx, self.my_addr)):
+            for entry in entries:
+                entry.append(root)
+
+    # Adds a signed transaction sent by one of our identities to the pending
+    # transactions, from where it is broadcasted to our peers. It is tracked
+    # until it is mined. Returns False if the transaction was rejected.
+    def submit(self, tx):
+        if not self.app.services.chain.add_local_transaction(tx):
+            log.warn('delivery rejected', tx=tx)
+            self.stats.add_error('rejected')
+            self.nonces.reject(tx.sender)
+            return False
+        self.tracker.add(tx)
+        return True
+
+    # Returns the requests of a rejected delivery to ENCRYPTED. They are
+    # delivered again with a new transaction on the next head.
+    def undeliver(self, batch):
+        for request in batch:
+            request.delivery = None
+            if request.hash:
+                self.journal.update(request.hash, ENCRYPTED, '')
+        self.undelivered.append(batch)
+
+    def redeliver(self):
+        batches, self.undelivered = self.undelivered, []
+        log.info('redelivering rejected deliveries', num=len(batches))
+        self.send_deliveries(batches)
+
+    # Requeues the requests that were not answered before the last shutdown and
+    # resubmits the deliveries that did not make it into the chain. Resubmitting
+    # is idempotent, as the very same signed transaction is sent again. The
+    # numbers of the requests encrypted already, and of the requests of a
+    # delivery rejected, e.g. because another transaction used its nonce, are
+    # delivered again, so a requester never gets two different numbers.
+    def recover(self):
+        index = self.app.services.chain.chain.index
+        deliveries = OrderedDict()  # delivery hash: (delivery, [(request tx, record)])
+        encrypted = []  # (request tx, record)
+        for hash, record in self.journal.recover():
+            state, request, delivery_hash, delivery = record[:4]
+            tx = rlp.decode(request, Transaction)
+            if state == DELIVERED:
+                deliveries.setdefault(delivery_hash, (delivery, []))[1].append((tx, record))
+            elif state == ENCRYPTED and record[5]:
+                encrypted.append((tx, record))
+            elif not self.tx_queue.put(tx):
+                self.drop_request(tx)
+        for delivery_hash, (delivery, requests) in deliveries.items():
+            try:
+                index.get_transaction(delivery_hash)
+            except KeyError:  # not mined
+                delivery = self.crypto_pool.decode_signed(delivery, requests[0][0].to)
+                if self.submit(delivery):
+                    continue
+                # revealed at the publish_on of the new delivery instead
+                hashes = set(tx.hash for tx, _ in requests)
+                self.reveals.cancel(decode_payload(delivery.data).publish_on, hashes)
+                for tx, record in requests:
+                    self.journal.update(tx.hash, ENCRYPTED, '')
+                encrypted.extend(requests)
+        requests = []
+        pubkeys = self.pubkeys.recover([tx for tx, _ in encrypted])
+        for (tx, record), pubkey in zip(encrypted, pubkeys):
+            if pubkey is None:  # invalid signature
+                self.drop_request(tx)
+                continue
+            request = RNORequest(tx)
+            request.pubkey, request.requester = pubkey, rno_crypto.pubtoaddr(pubkey)
+            request.number, request.enc_num = record[4], record[5]
+            requests.append(request)
+        self.journal.commit()
+        if requests:
+            log.info('delivering recovered requests', num=len(requests))
+            self.deliver_many(requests)
+
+    def delivery_payload(self, requests, when=None, publish_on=None):
+        when = when or int(round(time()))
+        fields = dict(when=when,
+                      publish_on=publish_on or when + self.config['rno']['reveal_delay'],
+                      published_at='http://www.example.com/foo')
+        if len(requests) == 1:
+            payload = DeliveryPayload(version=PAYLOAD_VERSION, number=requests[0].enc_num,
+                                      **fields)
+        else:
+            payload = BatchDeliveryPayload(version=BATCH_PAYLOAD_VERSION,
+                                           numbers=[[r.requester, r.enc_num] for r in requests],
+                                           **fields)
+        return encode_payload(payload, self.config['rno']['payload_format'])
+
+    # Reveals the numbers due, entries are [request hash, number(, merkle root)].
+    # Called by the reveal scheduler, which removes the entries once this returns.
+    def reveal(self, entries):
+        committed = OrderedDict()  # root: entries committed to it, in leaf order
+        for entry in entries:
+            hash, number = entry[:2]
+            if len(entry) > 2:
+                committed.setdefault(entry[2], []).append(entry)
+            else:
+                # publishing the number is not specified yet
+                log.debug('RNO reveal', request=hash.encode('hex'), number=number.encode('hex'))
+            if hash:
+                self.journal.update(hash, REVEALED)
+        for root, batch in committed.items():
+            self.reveal_committed(root, batch)
+        self.journal.commit()
+
+    # Reveals a batch of numbers committed to with the merkle root, each with the
+    # proof of its inclusion. The proofs are generated from a single tree.
+    def reveal_committed(self, root, entries):
+        levels = rno_merkle.merkle_tree([rno_merkle.leaf(h, n) for h, n, _ in entries])
+        if levels[-1][0] != root:
+            log.error('RNO reveal does not match commitment', root=root.encode('hex'))
+            return
+        for index, ((hash, number, _), proof) in enumerate(zip(entries,
+                                                                rno_merkle.merkle_proofs(levels))):
+            # publishing the number is not specified yet
+            log.debug('RNO reveal', request=hash.encode('hex'), number=number.encode('hex'),
+                      root=root.encode('hex'), index=index, proof=[p.encode('hex') for p in proof])
 
     # Sends the reply back to Requester and Reveal Host
     def send_replies(self, number, requester_addr, reveal_host_addr,
@@ -131,13 +898,49 @@ class RNOService(BaseService):
         log.debug('RNO pub address', address=address)
         return address
 
-    # This will make the loop_body be executed by RNOService thread.
+    # Wakes up the workers, which process the queue until it is empty.
     def wakeup(self):
-        self.interrupt.set()
+        self.requests_available.set()
+
+    def start(self):
+        super(RNOService, self).start()
+        self.recover()
+        self.scan_greenlet = gevent.spawn(self._scan)
+        self.journal.start()
+        self.reveals.start()
+        self.reservoir.start()
+        self.wakeup()
+
+    # Stops taking requests, lets the workers drain the queue and then stops
+    # the pipeline.
+    def stop(self):
+        self.stopping = True
+        if self.scan_greenlet is not None:
+            self.scan_greenlet.kill()
+        self.wakeup()
+        gevent.joinall(self.workers)
+        if self.batcher is not None:
+            self.batcher.flush_all()
+        self.anchors.flush_all()
+        self.reservoir.stop()
+        self.reveals.stop()
+        self.journal.stop()
+        self.crypto_pool.stop()
+        super(RNOService, self).stop()
+
+    # Consumes the queue. Idle workers block on requests_available, so they
+    # don't cost anything and start as soon as a request is queued.
+    def _work(self):
+        max_requests = self.config['rno']['worker_batch_size']
+        while True:
+            while self.tx_queue.empty():
+                if self.stopping:
+                    return
+                self.requests_available.clear()
+                self.requests_available.wait()
+            self.loop_body(max_requests)
 
     # @override BaseService._run (Greenlet._run)
     def _run(self):
-        while True:
-            self.interrupt.wait()
-            self.loop_body()
-            self.interrupt.clear()
+        self.workers = [gevent.spawn(self._work) for _ in range(self.config['rno']['workers'])]
+        gevent.joinall(self.workers)
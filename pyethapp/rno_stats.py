@@ -0,0 +1,132 @@
+"""
+Performance statistics of the RNO pipeline.
+
+Timings are taken with :func:`monotonic`, so they are cheap and not affected by
+changes of the system clock.
+"""
+import os
+import time
+import ctypes
+import ctypes.util
+from collections import deque
+
+
+def _mk_monotonic():
+    try:
+        from time import monotonic  # python 3
+        return monotonic
+    except ImportError:
+        pass
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time  # no monotonic clock available
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+    t = timespec()
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _mk_monotonic()
+
+
+def percentile(sorted_values, p):
+    "the `p` percentile of the non empty list `sorted_values`"
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.))]
+
+
+class RNOStats(object):
+
+    """
+    Collects timings and error counts of the RNO pipeline.
+
+    Latencies are measured from :meth:`RNOService.add_transaction` to the
+    accepted delivery, confirmation times from submitting a delivery to the head
+    including it. The percentiles are computed over the samples taken within
+    the last `window` seconds, keeping at most `max_samples` of them. Requests
+    per second are counted per second of the window, so the rate is not capped
+    by `max_samples`.
+    """
+
+    stages = ('recover', 'encrypt', 'sign', 'apply')
+
+    def __init__(self, window=60., max_samples=10000):
+        self.window = window
+        self.latencies = deque(maxlen=max_samples)  # (finished at, latency)
+        self.confirmations = deque(maxlen=max_samples)  # (confirmed at, confirmation time)
+        self.stage_time = dict((s, 0.) for s in self.stages)
+        self.stage_count = dict((s, 0) for s in self.stages)
+        self.errors = dict(invalid=0, rejected=0)
+        self.delivered = 0
+        self.confirmed = 0
+        self.started_at = monotonic()
+        self.delivered_per_second = deque()  # [second, number of deliveries]
+
+    def add_stage(self, stage, started_at, num):
+        "records that `stage` processed `num` requests since `started_at`"
+        self.stage_time[stage] += monotonic() - started_at
+        self.stage_count[stage] += num
+
+    def add_latency(self, received_at):
+        now = monotonic()
+        self.latencies.append((now, now - received_at))
+        self.delivered += 1
+        second = int(now)
+        if self.delivered_per_second and self.delivered_per_second[-1][0] == second:
+            self.delivered_per_second[-1][1] += 1
+        else:
+            self.delivered_per_second.append([second, 1])
+
+    def add_confirmation(self, confirmation_time):
+        self.confirmations.append((monotonic(), confirmation_time))
+        self.confirmed += 1
+
+    def add_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def _recent(self, samples):
+        since = monotonic() - self.window
+        while samples and samples[0][0] < since:
+            samples.popleft()
+        return [l for _, l in samples]
+
+    def requests_per_second(self):
+        "deliveries per second within the last `window` seconds, or since the start"
+        now = monotonic()
+        while self.delivered_per_second and self.delivered_per_second[0][0] < now - self.window:
+            self.delivered_per_second.popleft()
+        elapsed = min(self.window, now - self.started_at)
+        if elapsed <= 0:
+            return 0.
+        return sum(n for _, n in self.delivered_per_second) / elapsed
+
+    def report(self):
+        "returns the statistics as json encodable dict, times in milliseconds"
+        recent = sorted(self._recent(self.latencies))
+        d = dict(delivered=self.delivered,
+                 confirmed=self.confirmed,
+                 requests_per_second=self.requests_per_second(),
+                 errors=dict(self.errors),
+                 stages=dict())
+        if recent:
+            for p in (50, 95, 99):
+                d['latency_p%d' % p] = percentile(recent, p) * 1000
+        confirmations = sorted(self._recent(self.confirmations))
+        if confirmations:
+            for p in (50, 95, 99):
+                d['confirmation_p%d' % p] = percentile(confirmations, p) * 1000
+        for s in self.stages:
+            count = self.stage_count[s]
+            d['stages'][s] = dict(count=count, total=self.stage_time[s] * 1000,
+                                  mean=self.stage_time[s] * 1000 / count if count else 0)
+        return d
@@ -250,8 +250,8 @@ class Synchronizer(object):
             log.debug('known block')
             return
 
-        # check pow
-        if not t_block.header.check_pow():
+        # check pow, off the hub if pow workers are configured
+        if not self.chainservice.pow_verifier.verify([t_block.header])[0]:
             log.warn('check pow failed, should ban!')
             return
 
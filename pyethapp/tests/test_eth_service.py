@@ -1,4 +1,7 @@
 import os
+import time
+import gevent
+from gevent.queue import Queue
 from pyethapp import monkeypatches
 from ethereum.db import EphemDB
 from pyethapp import eth_service
@@ -8,6 +11,7 @@ from pyethapp import eth_protocol
 from ethereum import slogging
 import rlp
 import tempfile
+import pytest
 slogging.configure(config_string=':info')
 
 
@@ -99,3 +103,120 @@ def test_receive_blocks_256():
 
 def test_receive_blocks_256_leveldb():
     receive_blocks(data256.decode('hex'), leveldb=True)
+
+
+def test_failed_import_stops_verify_stage():
+    eth = eth_service.ChainService(AppMock())
+    eth.pow_verifier.verify = lambda headers: [True] * len(headers)
+    eth.verified_queue = Queue(maxsize=1)  # the verify stage blocks on the full queue
+
+    class TransientBlockMock(object):
+
+        def __init__(self, i):
+            self.header = self
+            self.hash = 'block %d' % i
+
+    def add_verified_block(t_block, proto, pow_valid):
+        if t_block.hash == 'block 0':
+            raise ValueError('import failed')
+        imported.append(t_block.hash)
+    eth._add_verified_block = add_verified_block
+    imported = []
+    for i in range(4):
+        eth.block_queue.put((TransientBlockMock(i), None))
+    eth.add_blocks_lock = True
+    with pytest.raises(ValueError):
+        eth._add_blocks()
+    assert not eth.add_blocks_lock
+    gevent.sleep(0.01)
+    assert eth.verified_queue.empty()  # no blocks or end marker left behind
+    # the blocks not imported are queued again, the failed one is dropped
+    assert eth.block_queue.qsize() == 3
+
+    # the next import starts with them
+    eth.add_block(TransientBlockMock(4), None)
+    gevent.sleep(0.01)
+    assert imported == ['block 1', 'block 2', 'block 3', 'block 4']
+
+
+def test_transaction_broadcaster():
+    sent = []
+    broadcaster = eth_service.TransactionBroadcaster(sent.append, max_txs=3, window=0.01)
+    for i in range(4):
+        broadcaster.add(i)
+    assert sent == [[0, 1, 2]]  # full message is sent at once
+    gevent.sleep(0.05)
+    assert sent == [[0, 1, 2], [3]]  # rest is sent after the window
+
+
+def test_duplicates_filter():
+    f = eth_service.DuplicatesFilter(max_items=30000)
+    assert not any(f.known(i) for i in range(30000))
+    assert f.known(0)  # now the most recent item
+    assert not f.known(30000)  # evicts 1, the least recent item
+    assert 0 in f and 1 not in f
+    assert len(f) == 30000
+
+
+def test_broadcast_newblock_skips_known():
+    app = AppMock()
+    eth = eth_service.ChainService(app)
+    excluded = []
+
+    class PeerManagerMock(object):
+
+        def broadcast(self, protocol, command_name, args=[], kargs={}, num_peers=None,
+                      exclude_protos=[]):
+            excluded.append(exclude_protos)
+
+    app.services.peermanager = PeerManagerMock()
+    protos = [eth_protocol.ETHProtocol(PeerMock(app), eth) for i in range(3)]
+    for proto in protos:
+        eth.known_blocks[proto] = eth_service.DuplicatesFilter()
+    block = eth_protocol.ETHProtocol.newblock.decode_payload(newblk_rlp.decode('hex'))['block']
+    eth._mark_known(eth.known_blocks, protos[1], [block.header.hash])
+    eth.broadcast_newblock(block, 1, origin=protos[0])
+    assert excluded == [[protos[0], protos[1]]]  # the origin and the peer having the block
+    eth.broadcast_newblock(block, 1, origin=protos[2])
+    assert len(excluded) == 1
+
+
+class TxMock(object):
+
+    def __init__(self, hash):
+        self.hash = hash
+
+
+def test_resend_transaction_skips_known_filter():
+    eth = eth_service.ChainService(AppMock())
+
+    class ProtoMock(object):
+
+        def __init__(self):
+            self.sent = []
+
+        def send_transactions(self, *txs):
+            self.sent.append(list(txs))
+
+    protos = [ProtoMock() for i in range(2)]
+    for proto in protos:
+        eth.known_txs[proto] = eth_service.DuplicatesFilter()
+    tx = TxMock('a')
+    eth._broadcast_transactions([tx])
+    eth._broadcast_transactions([tx])
+    assert [proto.sent for proto in protos] == [[[tx]], [[tx]]]  # sent once
+    eth.resend_transaction(tx)
+    eth.tx_broadcaster.flush()
+    assert [proto.sent for proto in protos] == [[[tx], [tx]], [[tx], [tx]]]
+
+
+def test_time_slice_scheduler():
+    scheduler = eth_service.TimeSliceScheduler(time_slice=0.01)
+    ran = []
+    gevent.spawn(ran.append, True)
+    scheduler.checkpoint()  # starts the slice
+    scheduler.checkpoint()
+    assert not ran  # no context switch within the slice
+    time.sleep(0.02)  # uses up the slice without yielding
+    scheduler.checkpoint()
+    assert ran
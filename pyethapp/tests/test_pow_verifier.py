@@ -0,0 +1,75 @@
+import rlp
+from ethereum.blocks import BlockHeader
+from pyethapp import eth_protocol, eth_service
+from pyethapp.pow_verifier import PoWVerifier
+from pyethapp.tests.test_eth_service import AppMock, PeerMock, newblk_rlp, block_1
+
+
+def mk_newblock():
+    "the block and chain_difficulty of a newblock message, its proof of work is valid"
+    return eth_protocol.ETHProtocol.newblock.decode_payload(newblk_rlp.decode('hex'))
+
+
+def tampered(header):
+    "a copy of `header` with another nonce, so its proof of work is invalid"
+    header = rlp.decode(rlp.encode(header), BlockHeader)
+    header.nonce = '\x00' * 8
+    return header
+
+
+def valid_headers():
+    blocks = eth_protocol.ETHProtocol.blocks.decode_payload(
+        rlp.encode([rlp.decode(block_1.decode('hex'))]))
+    return [mk_newblock()['block'].header, blocks[0].header]
+
+
+def test_verify():
+    a, b = valid_headers()
+    headers = [a, tampered(a), b, tampered(b), a]
+    for num_workers in (0, 2):
+        verifier = PoWVerifier(num_workers)
+        try:
+            # the results are in the order of the headers
+            assert verifier.verify(headers) == [True, False, True, False, True]
+            assert verifier.verify([]) == []
+        finally:
+            verifier.stop()
+
+
+def test_stop():
+    verifier = PoWVerifier(2)
+    verifier.stop()
+    assert verifier.pool is None
+    verifier.stop()  # stopping twice is fine
+    # checked inline once stopped
+    header = valid_headers()[0]
+    assert verifier.verify([header, tampered(header)]) == [True, False]
+
+
+def test_receive_newblock_checks_pow():
+    app = AppMock()
+    eth = eth_service.ChainService(app)
+    verified = []
+    verify = eth.pow_verifier.verify
+
+    def verify_spy(headers):
+        verified.extend(headers)
+        return verify(headers)
+    eth.pow_verifier.verify = verify_spy
+    broadcasted = []
+    eth.broadcast_newblock = lambda block, chain_difficulty, origin=None: \
+        broadcasted.append(block)
+    proto = eth_protocol.ETHProtocol(PeerMock(app), eth)
+
+    newblock = mk_newblock()
+    newblock['block'].header = tampered(newblock['block'].header)
+    eth.on_receive_newblock(proto, **newblock)
+    assert len(verified) == 1
+    assert proto not in eth.synchronizer._protocols  # the peer is not followed
+    assert not broadcasted
+
+    newblock = mk_newblock()
+    eth.on_receive_newblock(proto, **newblock)
+    assert len(verified) == 2
+    assert eth.synchronizer._protocols[proto] == newblock['chain_difficulty']
+    assert broadcasted == [newblock['block']]
@@ -0,0 +1,32 @@
+import json
+from click.testing import CliRunner
+from pyethapp import app
+
+
+def rnobench(data_dir, *args, **kwargs):
+    num_requests = kwargs.get('num_requests', 20)
+    result = CliRunner().invoke(app.app, ['-d', data_dir] + list(args) +
+                                ['rnobench', '-n', str(num_requests), '-k', '4'])
+    assert result.exit_code == 0, result.output
+    return json.loads(result.output.splitlines()[-1])
+
+
+def test_rnobench(tmpdir):
+    results = rnobench(str(tmpdir))
+    assert results['delivered'] == 20
+    assert results['errors']['rejected'] == 0
+
+
+def test_rnobench_exceeds_block(tmpdir):
+    # the deliveries of more requests than fit into a block of the default gas limit
+    results = rnobench(str(tmpdir), num_requests=200)
+    assert results['delivered'] == 200
+    assert results['undelivered'] == 0
+    assert results['errors']['rejected'] == 0
+
+
+def test_rnobench_inadmissible(tmpdir):
+    # the requests pay a gas price of 10**12, none is admitted, the run still ends
+    results = rnobench(str(tmpdir), '-c', 'rno.min_gasprice=%d' % 10**13)
+    assert results['delivered'] == 0
+    assert results['errors']['inadmissible'] == 20
@@ -0,0 +1,81 @@
+import gevent
+import rlp
+from devp2p.crypto import ECCx
+from ethereum.transactions import Transaction
+from ethereum.utils import sha3, privtoaddr
+from pyethapp import rno_crypto
+from pyethapp.rno_crypto import CryptoPool, EntropyReservoir, PubkeyCache
+
+privkeys = [sha3('rno requester %d' % i) for i in range(4)]
+
+
+def mk_tx(privkey, nonce=0):
+    return Transaction(nonce, 10**12, 25000, '\x01' * 20, 0, '').sign(privkey)
+
+
+def test_crypto_pool_map_order():
+    rlp_txs = [rlp.encode(mk_tx(privkey)) for privkey in privkeys]
+    for num_workers in (0, 2):
+        pool = CryptoPool([], num_workers)
+        try:
+            pubkeys = pool.map(rno_crypto.recover_sender, rlp_txs)
+        finally:
+            pool.stop()
+        assert map(rno_crypto.pubtoaddr, pubkeys) == map(privtoaddr, privkeys)
+
+
+def test_ecies_encrypt():
+    privkey = privkeys[0]
+    pubkey = ECCx(None, privkey).raw_pubkey
+    for count in (1, 3):
+        numbers, enc = rno_crypto.encrypt_random_numbers(pubkey, rno_crypto.make_entropy(), count)
+        assert len(numbers) == 64 * count
+        assert ECCx(None, privkey).ecies_decrypt(enc) == numbers
+    # without an entry of the reservoir
+    numbers, enc = rno_crypto.encrypt_number((pubkey, None, 1))
+    assert ECCx(None, privkey).ecies_decrypt(enc) == numbers
+
+
+def test_entropy_reservoir():
+    reservoir = EntropyReservoir(CryptoPool([]), low=2, high=4)
+    reservoir.start()
+    gevent.sleep(0.1)
+    reservoir.stop()
+    assert len(reservoir) == 4
+    taken = [reservoir.take() for _ in range(6)]
+    assert taken[4:] == [None, None]
+    assert reservoir.hits == 4 and reservoir.misses == 2
+    # no number, iv or ephemeral key is handed out twice
+    for part in zip(*taken[:4]):
+        assert len(set(part)) == 4
+
+
+def received(tx):
+    "`tx` as received from a peer, its sender is not recovered yet"
+    return rlp.decode(rlp.encode(tx), Transaction)
+
+
+def test_pubkey_cache():
+    cache = PubkeyCache(CryptoPool([]), max_items=16)
+    tx = mk_tx(privkeys[0])
+    assert cache.lookup(received(tx)) is None
+    pubkey = cache.recover([received(tx)])[0]
+    assert rno_crypto.pubtoaddr(pubkey) == privtoaddr(privkeys[0])
+    assert cache.misses == 1
+
+    # the same tx received again is found by its signing hash
+    assert cache.lookup(received(tx)) == pubkey
+    # another tx of the sender is only found by address once the sender is known
+    other = received(mk_tx(privkeys[0], nonce=1))
+    assert cache.lookup(other) is None
+    other.sender = privtoaddr(privkeys[0])
+    assert cache.lookup(other) == pubkey
+
+    assert cache.recover([other, received(tx)]) == [pubkey, pubkey]
+    assert cache.hits == 2 and cache.misses == 1
+
+    # invalid signatures are not cached
+    invalid = received(mk_tx(privkeys[1]))
+    invalid.v = 0
+    assert cache.recover([invalid]) == [None]
+    assert cache.lookup(invalid) is None
@@ -0,0 +1,95 @@
+from ethereum.db import EphemDB
+from ethereum.transactions import Transaction
+from ethereum.utils import sha3
+from pyethapp.rno_journal import RNOJournal, RECEIVED, ENCRYPTED, DELIVERED, REVEALED, DROPPED
+
+privkey = sha3('rno requester')
+
+
+def mk_tx(nonce):
+    return Transaction(nonce, 10**12, 25000, '\x01' * 20, 0, '').sign(privkey)
+
+
+def test_recover():
+    db = EphemDB()
+    journal = RNOJournal(db)
+    txs = [mk_tx(i) for i in range(4)]
+    for tx in txs:
+        assert journal.received(tx)
+    assert not journal.received(txs[0])
+    journal.commit()
+    journal.update(txs[1].hash, ENCRYPTED)
+    journal.update(txs[2].hash, DELIVERED, 'delivery')
+    journal.update(txs[3].hash, REVEALED)
+    journal.commit()
+
+    journal = RNOJournal(db)
+    pending = dict(journal.recover())
+    assert sorted(pending) == sorted(tx.hash for tx in txs[:3])
+    assert pending[txs[0].hash][0] == RECEIVED
+    assert pending[txs[1].hash][0] == ENCRYPTED
+    assert pending[txs[2].hash][0] == DELIVERED
+    assert pending[txs[2].hash][2] == sha3('delivery')
+    assert pending[txs[2].hash][3] == 'delivery'
+    # answered requests are still known
+    assert not journal.received(txs[3])
+
+
+def test_compaction():
+    db = EphemDB()
+    journal = RNOJournal(db)
+    txs = [mk_tx(i) for i in range(3)]
+    for tx in txs:
+        journal.received(tx)
+        journal.commit()
+    assert journal.next_seq - journal.first_seq == 3
+    for tx in txs[:2]:
+        journal.update(tx.hash, REVEALED)
+    journal.commit()
+    # only the segment of the last request is live
+    assert journal.first_seq == 2
+    assert [h for h, _ in RNOJournal(db).recover()] == [txs[2].hash]
+
+
+def test_height():
+    db = EphemDB()
+    journal = RNOJournal(db)
+    assert journal.height is None
+    journal.set_height(0)
+    journal.commit()
+    assert RNOJournal(db).height == 0
+    journal.set_height(42)
+    journal.commit()
+    assert RNOJournal(db).height == 42
+
+
+def test_dropped():
+    db = EphemDB()
+    journal = RNOJournal(db)
+    txs = [mk_tx(i) for i in range(2)]
+    for tx in txs:
+        journal.received(tx)
+    journal.commit()
+    journal.update(txs[0].hash, DROPPED)
+    journal.commit()
+    assert txs[0].hash not in journal and txs[1].hash in journal
+
+    journal = RNOJournal(db)
+    assert [h for h, _ in journal.recover()] == [txs[1].hash]
+    # only the segment of the pending request is live
+    assert journal.first_seq == 0 and len(journal.live) == 1
+    # a dropped request is taken again
+    assert journal.received(txs[0])
+    assert journal.get(txs[0].hash)[0] == RECEIVED
+
+
+def test_encrypted():
+    db = EphemDB()
+    journal = RNOJournal(db)
+    tx = mk_tx(0)
+    journal.received(tx)
+    journal.encrypted(tx.hash, 'number', 'encrypted number')
+    journal.commit()
+    (hash, record), = RNOJournal(db).recover()
+    assert record[0] == ENCRYPTED
+    assert record[4:] == ['number', 'encrypted number']
@@ -0,0 +1,26 @@
+from ethereum.utils import sha3
+from pyethapp.rno_merkle import leaf, merkle_tree, merkle_root, merkle_proofs, verify_proof
+
+
+def mk_leaves(num):
+    return [leaf(sha3('request %d' % i), sha3('number %d' % i) * 2) for i in range(num)]
+
+
+def test_proofs():
+    for num in range(1, 18):
+        leaves = mk_leaves(num)
+        levels = merkle_tree(leaves)
+        root = levels[-1][0]
+        assert root == merkle_root(leaves)
+        proofs = merkle_proofs(levels)
+        assert len(proofs) == num
+        for index, (l, proof) in enumerate(zip(leaves, proofs)):
+            assert len(proof) == len(levels) - 1  # log2(num), rounded up
+            assert verify_proof(l, index, proof, root)
+            assert not verify_proof(leaf('x' * 32, 'y' * 64), index, proof, root)
+
+
+def test_leaf_is_not_a_node():
+    leaves = mk_leaves(2)
+    # the concatenated children of a node are not a leaf with the same hash
+    assert leaf(leaves[0], leaves[1]) != merkle_root(leaves)
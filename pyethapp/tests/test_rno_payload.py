@@ -0,0 +1,104 @@
+import os
+import pytest
+from pyethapp import rno_payload
+from pyethapp.rno_payload import (DeliveryPayload, BatchDeliveryPayload, encode_payload,
+                                  decode_payload, intrinsic_gas, batch_entry_gas, number_for)
+from devp2p.crypto import ECCx
+
+# a random number encrypted with ECIES as delivered by the RNO
+enc_num = ECCx.encrypt(os.urandom(64), ECCx(None).raw_pubkey)
+
+
+def mk_payload():
+    return DeliveryPayload(version=rno_payload.PAYLOAD_VERSION, when=1434000000,
+                           publish_on=1434086400, published_at='http://www.example.com/foo',
+                           number=enc_num)
+
+
+def test_roundtrip():
+    payload = mk_payload()
+    for format in rno_payload.PAYLOAD_FORMATS:
+        decoded = decode_payload(encode_payload(payload, format))
+        assert decoded.when == payload.when
+        assert decoded.publish_on == payload.publish_on
+        assert decoded.published_at == payload.published_at
+        assert decoded.number == payload.number
+
+
+def mk_batch_payload(num):
+    numbers = [[chr(i) * 20, enc_num] for i in range(num)]
+    return BatchDeliveryPayload(version=rno_payload.BATCH_PAYLOAD_VERSION, when=1434000000,
+                                publish_on=1434086400, published_at='http://www.example.com/foo',
+                                numbers=numbers)
+
+
+def test_batch_roundtrip():
+    payload = mk_batch_payload(3)
+    for format in rno_payload.PAYLOAD_FORMATS:
+        decoded = decode_payload(encode_payload(payload, format))
+        assert isinstance(decoded, BatchDeliveryPayload)
+        assert [list(x) for x in decoded.numbers] == payload.numbers
+        assert number_for(decoded, chr(1) * 20) == enc_num
+        assert number_for(decoded, chr(9) * 20) is None
+
+
+def test_invalid():
+    for data in ('', '{"when": 1}', '\xc1\x02'):
+        with pytest.raises(ValueError):
+            decode_payload(data)
+    payload = mk_payload()
+    payload.version = max(rno_payload.payload_classes) + 1
+    with pytest.raises(ValueError):
+        decode_payload(encode_payload(payload))
+
+
+def test_size_and_gas():
+    payload = mk_payload()
+    rlp_data = encode_payload(payload, 'rlp')
+    json_data = encode_payload(payload, 'json')
+    print 'size rlp:%d json:%d' % (len(rlp_data), len(json_data))
+    print 'gas rlp:%d json:%d' % (intrinsic_gas(rlp_data), intrinsic_gas(json_data))
+    # the number is included as raw bytes, plus a few bytes of rlp overhead
+    assert len(rlp_data) < len(enc_num) + 64
+    assert len(rlp_data) < len(json_data)
+    assert intrinsic_gas(rlp_data) < intrinsic_gas(json_data)
+
+
+def test_batch_gas():
+    num = 16
+    single = intrinsic_gas(encode_payload(mk_payload()))
+    batch = intrinsic_gas(encode_payload(mk_batch_payload(num)))
+    print 'gas %d single deliveries:%d batch:%d' % (num, num * single, batch)
+    # the base cost of a transaction is only paid once
+    assert batch < num * single / 2
+
+
+def test_commit_roundtrip():
+    payload = rno_payload.CommitPayload(version=rno_payload.COMMIT_PAYLOAD_VERSION,
+                                        when=1434000000, publish_on=1434086400,
+                                        root='\x01' * 32, count=100)
+    for format in rno_payload.PAYLOAD_FORMATS:
+        decoded = decode_payload(encode_payload(payload, format))
+        assert isinstance(decoded, rno_payload.CommitPayload)
+        assert decoded.root == payload.root
+        assert decoded.count == payload.count
+        assert number_for(decoded, chr(1) * 20) is None
+
+
+def test_request_count():
+    assert rno_payload.request_count('', 256) == 1
+    assert rno_payload.request_count('\x10', 256) == 16
+    assert rno_payload.request_count('\x01\x00', 256) == 256
+    for data in ('\x00', '\x00\x01', '\x01\x01', '\x01' * 5):
+        with pytest.raises(ValueError):
+            rno_payload.request_count(data, 256)
+
+
+def test_batch_entry_gas():
+    num = 16
+    for format in rno_payload.PAYLOAD_FORMATS:
+        gas = intrinsic_gas(encode_payload(mk_batch_payload(num), format))
+        estimate = intrinsic_gas(encode_payload(mk_batch_payload(0), format)) + \
+            sum(batch_entry_gas(r, n, format) for r, n in mk_batch_payload(num).numbers)
+        # only the length prefix of the list of entries is not accounted for
+        assert abs(gas - estimate) <= 4 * 68
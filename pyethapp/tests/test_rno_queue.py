@@ -0,0 +1,89 @@
+from pyethapp.rno_queue import RequestQueue, DRRQueue
+
+
+class TxMock(object):
+
+    def __init__(self, gasprice, sender='a' * 20):
+        self.gasprice = gasprice
+        self._sender = sender
+
+
+def drain(q):
+    txs = []
+    while not q.empty():
+        txs.append(q.get())
+    return txs
+
+
+def test_priority():
+    q = RequestQueue()
+    txs = [TxMock(p) for p in (1, 3, 2, 3)]
+    for tx in txs:
+        assert q.put(tx)
+    assert q.qsize() == 4
+    assert q.oldest_wait() >= 0
+    # highest gas price first, arrival order for equal gas prices
+    assert drain(q) == [txs[1], txs[3], txs[2], txs[0]]
+    assert q.oldest_wait() == 0
+
+
+def test_drop_lowest():
+    dropped = []
+    q = RequestQueue(maxsize=2, drop_policy='lowest', drop_cb=dropped.append)
+    low, mid, high = TxMock(1), TxMock(2), TxMock(3)
+    assert q.put(mid)
+    assert q.put(low)
+    assert q.put(high)
+    assert not q.put(TxMock(1))
+    assert q.dropped['full'] == 2
+    assert dropped == [low]  # a new request that is not queued is not passed
+    assert drain(q) == [high, mid]
+
+
+def test_drop_newest_and_oldest():
+    q = RequestQueue(maxsize=2, drop_policy='newest')
+    txs = [TxMock(1), TxMock(1), TxMock(5)]
+    assert [q.put(tx) for tx in txs] == [True, True, False]
+    assert drain(q) == txs[:2]
+
+    q = RequestQueue(maxsize=2, drop_policy='oldest')
+    assert [q.put(tx) for tx in txs] == [True, True, True]
+    assert drain(q) == [txs[2], txs[1]]
+
+
+def test_max_per_requester():
+    q = RequestQueue(max_per_requester=2)
+    assert q.put(TxMock(1, 'a'))
+    assert q.put(TxMock(1, 'a'))
+    assert not q.put(TxMock(1, 'a'))
+    assert q.put(TxMock(1, 'b'))
+    assert q.dropped['requester'] == 1
+    q.get()
+    assert q.put(TxMock(1, 'a'))
+
+
+def test_drr_fairness():
+    q = DRRQueue(quantum=2)
+    heavy = [TxMock(1, 'h') for _ in range(6)]
+    light = [TxMock(1, 'l') for _ in range(2)]
+    big = TxMock(1, 'b')
+    for tx in heavy + light:
+        assert q.put(tx)
+    assert q.put(big, cost=4)
+    # every turn is worth two numbers, the big request waits for two turns
+    assert drain(q) == heavy[:2] + light + heavy[2:4] + [big] + heavy[4:]
+    assert q.oldest_wait() == 0
+
+
+def test_drr_drop_longest():
+    dropped = []
+    q = DRRQueue(maxsize=3, drop_cb=dropped.append)
+    a1, a2, b1 = TxMock(1, 'a'), TxMock(1, 'a'), TxMock(1, 'b')
+    for tx in (a1, a2, b1):
+        assert q.put(tx)
+    c1 = TxMock(1, 'c')
+    assert q.put(c1)  # drops the newest of 'a'
+    assert not q.put(TxMock(1, 'a'))  # would be the longest queue
+    assert q.dropped['full'] == 2
+    assert dropped == [a2]
+    assert drain(q) == [a1, b1, c1]
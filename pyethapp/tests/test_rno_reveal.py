@@ -0,0 +1,46 @@
+from ethereum.db import EphemDB
+from pyethapp.rno_reveal import RevealScheduler
+
+
+def entries(*names):
+    return [[n * 32, n * 64] for n in names]
+
+
+def test_schedule_and_reload():
+    db = EphemDB()
+    revealed = []
+    reveals = RevealScheduler(db, revealed.extend, tick=60)
+    reveals.schedule(1000, entries('a'))
+    reveals.schedule(1010, entries('b', 'c'))  # same bucket, new chunk
+    reveals.schedule(2000, entries('d'))
+    reveals.schedule(500, entries('e'))
+    assert len(reveals) == 3
+
+    # a restart only reads the list of buckets
+    reveals = RevealScheduler(db, revealed.extend, tick=60)
+    assert len(reveals) == 3
+    assert reveals.reveal_due(now=499) == 0
+    assert reveals.reveal_due(now=999) == 1  # never revealed before publish_on
+    assert reveals.reveal_due(now=1020) == 3  # all due buckets at once
+    assert [e[0][0] for e in revealed] == ['e', 'a', 'b', 'c']
+
+    reveals = RevealScheduler(db, revealed.extend, tick=60)
+    assert len(reveals) == 1
+    assert reveals.reveal_due(now=3000) == 1
+    assert len(RevealScheduler(db, revealed.extend, tick=60)) == 0
+
+
+def test_replace_and_cancel():
+    db = EphemDB()
+    revealed = []
+    reveals = RevealScheduler(db, revealed.extend, tick=60)
+    chunk = reveals.schedule(1000, entries('a', 'b'))
+    reveals.schedule(1010, entries('c', 'd'))
+    reveals.replace(chunk, entries('a'))
+    reveals.cancel(1010, set(['c' * 32]))
+    assert reveals.reveal_due(now=1020) == 2
+    assert [e[0][0] for e in revealed] == ['a', 'd']
+    # a chunk revealed already is not written again
+    reveals.replace(chunk, entries('b'))
+    assert reveals.reveal_due(now=1020) == 0
+    assert len(reveals) == 0
@@ -0,0 +1,22 @@
+import rlp
+from ethereum.transactions import Transaction
+from ethereum.utils import sha3, privtoaddr
+from pyethapp.rno_scan import find_requests
+
+privkey = sha3('rno requester')
+rno_privkey = sha3('rno')
+rno_addr = privtoaddr(rno_privkey)
+
+
+def mk_tx(nonce, to, privkey=privkey):
+    return Transaction(nonce, 10**12, 25000, to, 0, '').sign(privkey)
+
+
+def test_find_requests():
+    txs = [mk_tx(0, rno_addr), mk_tx(1, '\x02' * 20), mk_tx(2, rno_addr),
+           mk_tx(0, rno_addr, rno_privkey)]  # a batch delivery sent to ourselves
+    rlp_block = rlp.encode(['header', txs, []])
+    found = find_requests((frozenset([rno_addr]), rlp_block))
+    assert [rlp.decode(t, Transaction).hash for t, _ in found] == [txs[0].hash, txs[2].hash]
+    assert [sender for _, sender in found] == [privtoaddr(privkey)] * 2
+    assert find_requests((frozenset(['\x03' * 20]), rlp_block)) == []
@@ -0,0 +1,302 @@
+import time
+import gevent
+import pytest
+from ethereum.db import EphemDB
+from ethereum.transactions import Transaction
+from ethereum.utils import sha3, privtoaddr
+from pyethapp import rno_crypto, rno_merkle
+from pyethapp.rno_journal import ENCRYPTED, DELIVERED
+from pyethapp.rno_payload import decode_payload
+from pyethapp.rno_service import (RNOService, RNORequest, DeliveryTracker, DeliveryBatcher,
+                                  NonceManager, RateLimiter)
+
+rno_privkey = sha3('rno')
+requester_privkey = sha3('rno requester')
+
+
+class TxMock(object):
+
+    def __init__(self, hash):
+        self.hash = hash
+
+
+class BlockMock(object):
+
+    def __init__(self, number, txs=[], nonces=None):
+        self.number = number
+        self.txs = txs
+        self.nonces = nonces or dict()
+
+    def get_transactions(self):
+        return self.txs
+
+    def get_nonce(self, addr):
+        return self.nonces.get(addr, 0)
+
+
+class ChainMock(object):
+
+    def __init__(self):
+        self.head = BlockMock(0)
+        self.head_candidate = BlockMock(1)
+        self.index = self
+
+    def get_transaction(self, hash):
+        raise KeyError(hash)  # nothing is mined
+
+
+def test_delivery_tracker():
+    chain = ChainMock()
+    resent = []
+    tracker = DeliveryTracker(chain, resent.append, resend_after=2)
+    txs = [TxMock(chr(i) * 32) for i in range(3)]
+    for tx in txs:
+        tracker.add(tx)
+    assert len(tracker) == 3
+
+    chain.head = BlockMock(1, [txs[0], TxMock('x' * 32)])
+    assert len(tracker.on_new_head(chain.head)) == 1
+    assert len(tracker) == 2 and not resent
+
+    chain.head = BlockMock(2, [txs[1]])
+    assert len(tracker.on_new_head(chain.head)) == 1
+    assert resent == [txs[2]]  # not mined 2 blocks after it was sent
+
+    chain.head = BlockMock(3)
+    assert tracker.on_new_head(chain.head) == []
+    assert resent == [txs[2]]  # resent again 2 blocks after the last resend
+    chain.head = BlockMock(4, [txs[2]])
+    assert len(tracker.on_new_head(chain.head)) == 1
+    assert len(tracker) == 0 and tracker.resent == 1
+
+
+def test_nonce_manager():
+    chain = ChainMock()
+    chain.head_candidate.nonces['a'] = 3  # pending transactions are accounted for
+    nonces = NonceManager(chain)
+    assert nonces.allocate('a', 2) == 3
+    assert nonces.allocate('a') == 5
+    assert nonces.allocate('b') == 0
+    nonces.release('b')
+
+    # a rejection while nonces are in flight only resyncs once all are released
+    nonces.release('a', 2)
+    nonces.reject('a')
+    assert nonces.allocate('a') == 6
+    nonces.release('a')
+    assert nonces.allocate('a') == 7
+    nonces.release('a', 2)
+    assert nonces.allocate('a') == 3
+    nonces.release('a')
+    # without nonces in flight at once
+    chain.head_candidate.nonces['a'] = 4
+    nonces.reject('a')
+    assert nonces.allocate('a') == 4
+    nonces.release('a')
+
+    # a new head raises, but never lowers the nonces
+    nonces.on_new_head(BlockMock(1, nonces=dict(a=9, b=0)))
+    assert nonces.allocate('a') == 9
+    assert nonces.allocate('b') == 1
+
+
+class ChainServiceMock(object):
+
+    def __init__(self):
+        self.chain = ChainMock()
+        self.on_new_head_cbs = []
+        self.added = []  # the transactions accepted, in order
+        self.rejects = 0  # number of transactions to reject
+
+    def resend_transaction(self, tx):
+        "broadcasts `tx` again"
+
+    def add_local_transaction(self, tx):
+        candidate = self.chain.head_candidate
+        if self.rejects:
+            self.rejects -= 1
+            return False
+        if tx.nonce != candidate.get_nonce(tx.sender):
+            return False
+        candidate.nonces[tx.sender] = tx.nonce + 1
+        self.added.append(tx)
+        return True
+
+
+class ServicesMock(dict):
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class AppMock(object):
+
+    def __init__(self, **rno_config):
+        config = dict(RNOService.default_config['rno'])
+        config.update(rno_config)
+        self.config = dict(eth=dict(privkey_hex=rno_privkey.encode('hex')), rno=config)
+        self.services = ServicesMock(db=EphemDB(), chain=ChainServiceMock())
+
+
+def mk_request(nonce=0, to=None, privkey=requester_privkey):
+    return Transaction(nonce, 10**12, 25000, to or privtoaddr(rno_privkey), 0, '').sign(privkey)
+
+
+def test_add_transaction_filters_recipients():
+    other_privkey = sha3('rno 2')
+    rno = RNOService(AppMock(privkeys_hex=[other_privkey.encode('hex')]))
+    rno.add_transaction(mk_request(to='\x01' * 20))
+    assert rno.tx_queue.empty()
+    # requests to any of the identities are queued, but only once
+    txs = [mk_request(0), mk_request(1, to=privtoaddr(other_privkey))]
+    for tx in txs + txs:
+        rno.add_transaction(tx)
+    assert [rno.tx_queue.get() for _ in txs] == txs
+    assert rno.tx_queue.empty()
+
+
+def test_add_transaction_skips_own():
+    rno = RNOService(AppMock())
+    tx = mk_request(privkey=rno_privkey)
+    tx.sender = privtoaddr(rno_privkey)
+    rno.add_transaction(tx)
+    assert rno.tx_queue.empty()
+    assert 'inadmissible' not in rno.stats.errors
+
+
+def test_delivery_batcher_caps_gas():
+    flushed = []
+    batcher = DeliveryBatcher(flushed.extend, 4, 60, lambda r: r.count, lambda: 5)
+    requests = [RNORequest(None, 'a') for _ in range(5)]
+    for request, count in zip(requests, (2, 2, 2, 1, 1)):
+        request.count = count
+    assert batcher.add(requests[0]) == []
+    assert batcher.add(requests[1]) == []
+    assert batcher.add(requests[2]) == [requests[:2]]  # would use 6 gas
+    assert batcher.add(requests[3]) == []
+    assert batcher.add(requests[4]) == []
+    batcher.flush_all()
+    assert flushed == [requests[2:]]
+
+
+def test_concurrent_deliveries_keep_nonce_order():
+    app = AppMock()
+    rno = RNOService(app)
+    crypto_map = rno.crypto_pool.map
+    delays = [0.05, 0]
+
+    def slow_map(func, jobs):
+        if func is rno_crypto.sign_delivery:  # the first delivery is signed slowly
+            gevent.sleep(delays.pop(0))
+        return crypto_map(func, jobs)
+    rno.crypto_pool.map = slow_map
+
+    batches = []
+    for i in range(2):
+        request = RNORequest(None, rno.my_addr)
+        request.requester, request.enc_num = privtoaddr(requester_privkey), 'number %d' % i
+        batches.append([request])
+    gevent.joinall([gevent.spawn(rno.send_deliveries, [batch]) for batch in batches])
+    assert [tx.nonce for tx in app.services.chain.added] == [0, 1]
+    assert rno.stats.errors['rejected'] == 0
+    assert not rno.nonces.in_flight
+
+
+def test_rejected_delivery_is_redelivered():
+    app = AppMock()
+    rno = RNOService(app)
+    chainservice = app.services.chain
+    chainservice.rejects = 1
+    request = RNORequest(mk_request(), received_at=0.)
+    rno.journal.received(request.tx)
+    request.requester = privtoaddr(requester_privkey)
+    request.number, request.enc_num = 'number', 'encrypted number'
+    rno.send_deliveries([[request]])
+    assert not chainservice.added
+    assert rno.undelivered == [[request]]
+    assert rno.stats.delivered == 0  # only accepted deliveries count
+    state, _, delivery_hash, delivery = rno.journal.get(request.hash)[:4]
+    assert state == ENCRYPTED and delivery_hash == delivery == ''
+
+    rno.on_new_head(BlockMock(1))
+    gevent.sleep(0.01)
+    assert [tx.nonce for tx in chainservice.added] == [0]
+    assert rno.journal.get(request.hash)[0] == DELIVERED
+    assert not rno.undelivered
+    assert rno.stats.delivered == 1
+
+
+def test_recover_delivers_journaled_numbers():
+    app = AppMock()
+    rno = RNOService(app)
+    chainservice = app.services.chain
+    requests = [RNORequest(mk_request(i)) for i in range(2)]
+    for i, request in enumerate(requests):
+        rno.journal.received(request.tx)
+        request.requester = privtoaddr(requester_privkey)
+        request.number, request.enc_num = 'number %d' % i, 'encrypted number %d' % i
+        rno.journal.encrypted(request.hash, request.number, request.enc_num)
+    # the second request is delivered, the first one is not
+    rno.send_deliveries([requests[1:]])
+    assert [tx.nonce for tx in chainservice.added] == [0]
+
+    # the resubmitted delivery is rejected, as its nonce was used since
+    rno = RNOService(app)
+    rno.recover()
+    added = chainservice.added[1:]
+    assert [tx.nonce for tx in added] == [1, 2]
+    assert [decode_payload(tx.data).number for tx in added] == \
+        ['encrypted number 0', 'encrypted number 1']
+    for request in requests:
+        assert rno.journal.get(request.hash)[0] == DELIVERED
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(0, 3)
+    assert limiter.take('a', 2)
+    assert not limiter.take('a', 2)
+    assert limiter.take('a')
+    assert limiter.take('b', 3)
+    limiter = RateLimiter(1000, 1)
+    assert limiter.take('a') and not limiter.take('a', 2)
+
+
+def test_offchain_rate_limit():
+    rno = RNOService(AppMock(offchain_rate=0., max_numbers_per_request=1))
+    assert rno.request(mk_request(0))
+    with pytest.raises(ValueError):
+        rno.request(mk_request(1))
+    assert rno.stats.errors['rate_limited'] == 1
+    # other requesters are served
+    assert rno.request(mk_request(0, privkey=sha3('rno requester 2')))
+
+
+def test_rejected_delivery_is_not_revealed():
+    other_privkey = sha3('rno 2')
+    app = AppMock(privkeys_hex=[other_privkey.encode('hex')], merkle_commit=True)
+    rno = RNOService(app)
+    revealed = []
+    rno.reveals.reveal_cb = revealed.extend
+    chainservice = app.services.chain
+    chainservice.rejects = 1
+    # the delivery sent by the other identity is rejected
+    requests = [RNORequest(mk_request(0, to=privtoaddr(other_privkey))),
+                RNORequest(mk_request(1))]
+    for i, request in enumerate(requests):
+        rno.journal.received(request.tx)
+        request.requester = privtoaddr(requester_privkey)
+        request.number, request.enc_num = 'number %d' % i, 'encrypted number %d' % i
+    rno.send_deliveries([[r] for r in requests])
+    assert rno.undelivered == [requests[:1]]
+    assert rno.journal.get(requests[0].hash)[0] == ENCRYPTED
+
+    # the commitment follows the accepted delivery and only covers its number
+    delivery, commitment = chainservice.added
+    root = rno_merkle.merkle_root([rno_merkle.leaf(requests[1].hash, 'number 1')])
+    assert decode_payload(commitment.data).root == root
+    assert (delivery.nonce, commitment.nonce) == (0, 1)
+    rno.reveals.reveal_due(now=time.time() + 10**6)
+    assert revealed == [[requests[1].hash, 'number 1', root]]
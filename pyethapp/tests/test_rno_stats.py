@@ -0,0 +1,105 @@
+import pytest
+from pyethapp import rno_stats
+from pyethapp.rno_stats import RNOStats, percentile
+from pyethapp.jsonrpc import RNO
+from pyethapp.rno_service import RNOService
+from pyethapp.tests.test_rno_service import AppMock
+
+
+class ClockMock(object):
+
+    def __init__(self, now=1000.):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = ClockMock()
+    monkeypatch.setattr(rno_stats, 'monotonic', clock)
+    return clock
+
+
+def test_monotonic():
+    t = rno_stats.monotonic()
+    assert rno_stats.monotonic() >= t
+
+
+def test_percentile():
+    values = range(100)
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 99
+    assert percentile([7], 95) == 7
+
+
+def test_latency_percentiles(clock):
+    stats = RNOStats(window=60.)
+    for i in range(100):
+        stats.add_latency(clock.now - i / 1000.)
+    report = stats.report()
+    assert report['delivered'] == 100
+    assert abs(report['latency_p50'] - 50) < 1e-6
+    assert abs(report['latency_p99'] - 99) < 1e-6
+    assert 'confirmation_p50' not in report
+    stats.add_confirmation(2.)
+    assert stats.report()['confirmation_p50'] == 2000
+
+
+def test_requests_per_second_not_capped(clock):
+    stats = RNOStats(window=60., max_samples=10)
+    for second in range(60):
+        clock.now += 1
+        for i in range(500):
+            stats.add_latency(clock.now)
+    report = stats.report()
+    assert report['requests_per_second'] == 500
+    assert len(stats.latencies) == 10  # only the percentiles are sampled
+
+
+def test_requests_per_second_since_start(clock):
+    stats = RNOStats(window=60.)
+    assert stats.report()['requests_per_second'] == 0
+    clock.now += 2
+    for i in range(100):
+        stats.add_latency(clock.now)
+    # not averaged over the whole window yet
+    assert stats.report()['requests_per_second'] == 50
+
+
+def test_window(clock):
+    stats = RNOStats(window=10.)
+    stats.add_latency(clock.now)
+    stats.add_confirmation(1.)
+    clock.now += 20
+    report = stats.report()
+    assert report['delivered'] == 1 and report['confirmed'] == 1
+    assert report['requests_per_second'] == 0
+    assert 'latency_p50' not in report and 'confirmation_p50' not in report
+
+
+def test_stages(clock):
+    stats = RNOStats()
+    started_at = clock.now
+    clock.now += 0.5
+    stats.add_stage('sign', started_at, 10)
+    stats.add_stage('sign', started_at, 10)
+    stats.add_error('invalid')
+    report = stats.report()
+    assert report['stages']['sign'] == dict(count=20, total=1000, mean=50)
+    assert report['stages']['recover'] == dict(count=0, total=0, mean=0)
+    assert report['errors'] == dict(invalid=1, rejected=0)
+
+
+def test_rpc_report():
+    dispatcher = RNO()
+    dispatcher.rno = RNOService(AppMock())
+    report = dispatcher.stats()
+    for key in ('delivered', 'confirmed', 'requests_per_second', 'errors', 'stages', 'queue',
+                'reservoir', 'pubkey_cache', 'unconfirmed'):
+        assert key in report
+    assert sorted(report['stages']) == sorted(RNOStats.stages)
+    assert sorted(report['queue']) == ['depth', 'dropped', 'oldest_wait', 'scheduling']
+    assert report['unconfirmed'] == dict(count=0, resent=0)
@@ -0,0 +1,91 @@
+from pyethapp.tx_pool import TransactionPool
+
+
+class TxMock(object):
+
+    def __init__(self, sender, nonce, gasprice=1, startgas=21000, value=0):
+        self.sender = sender
+        self.nonce = nonce
+        self.gasprice = gasprice
+        self.startgas = startgas
+        self.value = value
+        self.hash = '%s:%d:%d' % (sender, nonce, gasprice)
+
+
+class BlockMock(object):
+
+    gas_limit = 100000
+
+    def __init__(self, nonces=None):
+        self.nonces = dict(nonces or {})
+        self.txs = []
+        self.gas_used = 0
+
+    def get_nonce(self, address):
+        return self.nonces.get(address, 0)
+
+    def get_balance(self, address):
+        return 10 ** 18
+
+    def get_transactions(self):
+        return list(self.txs)
+
+
+class ChainMock(object):
+
+    def __init__(self):
+        self.head_candidate = BlockMock()
+
+    def add_transaction(self, tx):
+        block = self.head_candidate
+        if tx.nonce != block.get_nonce(tx.sender):
+            return False
+        block.nonces[tx.sender] = tx.nonce + 1
+        block.txs.append(tx)
+        block.gas_used += tx.startgas
+        return True
+
+
+def test_tx_pool_nonce_order():
+    chain = ChainMock()
+    pool = TransactionPool(chain)
+    txs = [TxMock('a', 2), TxMock('a', 0), TxMock('b', 0, gasprice=2), TxMock('a', 1)]
+    assert pool.add_transactions(txs + txs[:1]) == txs
+    assert chain.head_candidate.txs == [txs[2], txs[1], txs[3], txs[0]]
+    assert pool.add_transactions(txs) == []  # known
+    assert len(pool) == 4
+
+
+def test_tx_pool_new_head():
+    chain = ChainMock()
+    pool = TransactionPool(chain)
+    # only 4 txs fit into a block, the 5th is queued
+    txs = [TxMock('a', n) for n in range(5)]
+    pool.add_transactions(txs)
+    assert chain.head_candidate.txs == txs[:4]
+    assert txs[4].hash in pool
+    # txs 0 and 1 are mined, the chain forwards txs 2 and 3
+    mined = BlockMock()
+    mined.txs = txs[:2]
+    chain.head_candidate = BlockMock(nonces=dict(a=2))
+    for tx in txs[2:4]:
+        chain.add_transaction(tx)
+    pool.on_new_head(mined)
+    assert chain.head_candidate.txs == txs[2:]
+    assert len(pool) == 3
+
+
+def test_tx_pool_evicts_lowest_price():
+    chain = ChainMock()
+    pool = TransactionPool(chain, max_txs=3)
+    executable = TxMock('a', 0, gasprice=1)
+    queued = [TxMock('b', n, gasprice=p) for n, p in ((1, 3), (2, 2), (3, 4))]
+    pool.add_transactions([executable] + queued)
+    assert pool.evicted == 1
+    # the executable tx is in the head_candidate and kept although it pays least
+    assert executable.hash in pool
+    assert queued[1].hash not in pool
+    # a pooled tx is only replaced by one paying more
+    assert pool.add_transactions([TxMock('b', 1, gasprice=2)]) == []
+    assert pool.add_transactions([TxMock('b', 1, gasprice=5)])
+    assert queued[0].hash not in pool
@@ -0,0 +1,179 @@
+"""
+Pool of the transactions received from peers.
+
+The transactions of a ``transactions`` message are handled as one batch: the
+hashes seen before are dropped, then the senders of the others are recovered,
+which also checks their signatures, yielding to other greenlets every
+`recover_batch_size` transactions. Only then the transactions are checked
+against the state of the head_candidate and pooled.
+
+Per sender the transactions are kept by nonce. A transaction is added to the
+head_candidate as soon as it is the next one of its sender, followed by the
+transactions it makes executable, so the head_candidate is updated
+incrementally instead of being rebuilt. On a new head, the senders' next
+transactions are added best paying first.
+"""
+import heapq
+from itertools import count
+import gevent
+from ethereum import processblock
+from ethereum.slogging import get_logger
+from utils import LRUCache
+
+log = get_logger('eth.txpool')
+
+
+class TransactionPool(object):
+
+    """
+    The transactions received from peers, which are not yet in the chain.
+
+    The pool holds at most `max_txs` transactions. If it is full, the queued
+    transactions paying the lowest gas price are evicted, the ones in the
+    head_candidate are kept.
+    """
+
+    recover_batch_size = 64  # number of senders recovered before other greenlets get a turn
+    seen_size = 32768  # number of received transaction hashes remembered
+
+    def __init__(self, chain, max_txs=4096):
+        self.chain = chain
+        self.max_txs = max_txs
+        self.txs = dict()  # hash: tx
+        self.senders = dict()  # sender: {nonce: tx}
+        self.in_head_candidate = set()  # hashes of the pooled txs added to the head_candidate
+        self.by_price = []  # heap of (gasprice, seq, hash), holds entries of removed txs too
+        self.seq = count()
+        self.seen = LRUCache(self.seen_size)
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.txs
+
+    def add_transactions(self, txs):
+        """Adds the transactions received in one message.
+
+        :returns: the transactions which were added to the pool
+        """
+        new = []
+        for tx in txs:
+            if tx.hash not in self.seen:
+                self.seen[tx.hash] = True
+                new.append(tx)
+        recovered = []
+        for i, tx in enumerate(new):
+            try:
+                tx.sender
+            except processblock.InvalidTransaction as e:
+                log.debug('invalid signature', tx=tx, error=e)
+            else:
+                recovered.append(tx)
+            if i % self.recover_batch_size == self.recover_batch_size - 1:
+                gevent.sleep(0)
+        added = [tx for tx in recovered if self._validate(tx) and self._insert(tx)]
+        self._promote(set(tx.sender for tx in added))
+        self._evict()
+        return [tx for tx in added if tx.hash in self.txs]
+
+    def on_new_head(self, block):
+        "removes the transactions mined in `block` and fills the new head_candidate"
+        for tx in block.get_transactions():
+            if tx.hash in self.txs:
+                self._remove(self.txs[tx.hash])
+        # the chain forwarded the still valid transactions of the old head_candidate
+        candidate = self.chain.head_candidate
+        included = set(tx.hash for tx in candidate.get_transactions())
+        self.in_head_candidate = set(h for h in self.in_head_candidate if h in included)
+        for sender, queue in self.senders.items():
+            nonce = candidate.get_nonce(sender)
+            for tx in [tx for n, tx in queue.items() if n < nonce and tx.hash not in included]:
+                self._remove(tx)  # replaced by a transaction with the same nonce
+        self._promote(list(self.senders))
+
+    def _validate(self, tx):
+        "cheap checks against the state of the head_candidate, the chain checks the rest"
+        block = self.chain.head_candidate
+        if tx.nonce < block.get_nonce(tx.sender):
+            log.debug('stale nonce', tx=tx)
+            return False
+        if block.get_balance(tx.sender) < tx.startgas * tx.gasprice + tx.value:
+            log.debug('insufficient balance', tx=tx)
+            return False
+        return True
+
+    def _insert(self, tx):
+        queue = self.senders.get(tx.sender, dict())
+        old = queue.get(tx.nonce)
+        if old is not None:
+            # a transaction is only replaced by one paying more
+            if old.hash in self.in_head_candidate or tx.gasprice <= old.gasprice:
+                return False
+            self._remove(old)
+        self.senders.setdefault(tx.sender, dict())[tx.nonce] = tx
+        self.txs[tx.hash] = tx
+        heapq.heappush(self.by_price, (tx.gasprice, next(self.seq), tx.hash))
+        return True
+
+    def _remove(self, tx):
+        del self.txs[tx.hash]
+        self.in_head_candidate.discard(tx.hash)
+        queue = self.senders[tx.sender]
+        del queue[tx.nonce]
+        if not queue:
+            del self.senders[tx.sender]
+
+    def _next(self, sender):
+        "the pooled transaction of `sender` which can be added to the head_candidate or None"
+        queue = self.senders.get(sender)
+        if queue:
+            tx = queue.get(self.chain.head_candidate.get_nonce(sender))
+            if tx is not None and tx.hash not in self.in_head_candidate:
+                return tx
+
+    def _promote(self, senders):
+        "adds the executable transactions of `senders` to the head_candidate, best paying first"
+        heap = []
+        for sender in senders:
+            tx = self._next(sender)
+            if tx is not None:
+                heap.append((-tx.gasprice, next(self.seq), tx))
+        heapq.heapify(heap)
+        while heap:
+            tx = heapq.heappop(heap)[2]
+            if tx.hash not in self.txs:
+                continue
+            block = self.chain.head_candidate
+            if block.gas_used + tx.startgas > block.gas_limit:
+                continue  # stays queued for the next block
+            if self.chain.add_transaction(tx) is False:
+                log.debug('invalid tx', tx=tx)
+                self._remove(tx)
+                continue
+            self.in_head_candidate.add(tx.hash)
+            tx = self._next(tx.sender)
+            if tx is not None:
+                heapq.heappush(heap, (-tx.gasprice, next(self.seq), tx))
+
+    def _evict(self):
+        "evicts the queued transactions paying the lowest gas price while the pool is full"
+        kept = []
+        while len(self.txs) > self.max_txs and self.by_price:
+            entry = heapq.heappop(self.by_price)
+            tx = self.txs.get(entry[2])
+            if tx is None:
+                continue  # removed already
+            if tx.hash in self.in_head_candidate:
+                kept.append(entry)
+                continue
+            log.debug('evicting tx', tx=tx, gasprice=tx.gasprice)
+            self._remove(tx)
+            self.evicted += 1
+        for entry in kept:
+            heapq.heappush(self.by_price, entry)
+        if len(self.by_price) > 2 * len(self.txs) + self.recover_batch_size:
+            # drop the entries of the removed transactions
+            self.by_price = [e for e in self.by_price if e[2] in self.txs]
+            heapq.heapify(self.by_price)
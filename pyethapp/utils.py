@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import ethereum
 from ethereum.blocks import Block, genesis
 import rlp
@@ -56,3 +57,35 @@ def load_block_tests(data, db):
         rlpdata = ethereum.utils.decode_hex(blk['rlp'][2:])
         blocks.append(rlp.decode(rlpdata, Block, db=db, parent=blocks[-1]))
     return blocks
+
+
+class LRUCache(object):
+
+    """A mapping holding at most `max_items`, evicting the least recently used."""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)